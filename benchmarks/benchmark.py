@@ -0,0 +1,398 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2024 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+#
+# This program times the conflation engine on synthetic highway data,
+# so the speed of two commits can be compared on the same machine.
+# The data is generated from a seed, so every run uses the same roads.
+#
+
+import argparse
+import logging
+import sys
+import os
+import json
+import math
+import random
+import platform
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+from geojson import Feature, FeatureCollection, LineString
+import geojson
+from cpuinfo import get_cpu_info
+from osm_merge.conflator import Conflator, cachedRatio
+
+# Instantiate logger
+log = logging.getLogger(__name__)
+
+# Where the synthetic roads are, in the Medicine Bow National Forest
+ORIGIN = (-106.9, 40.9)
+# The number of meters in a degree of latitude
+METERS = 111320.0
+
+NAMES = ["Aspen", "Beaver Creek", "Bear Lake", "Cow Camp", "Deadman", "Elk Park",
+         "Fox Park", "Grouse", "Hog Park", "Independence", "Lost Creek", "Moose",
+         "North Fork", "Pole Mountain", "Rob Roy", "Sheep Mountain", "Sand Lake",
+         "Trail Creek", "Whisky Park", "Willow Creek"]
+
+def makeRoad(rng: random.Random,
+             start: tuple,
+             segments: int,
+             ) -> list:
+    """
+    Make a road as a random walk, in meters from the origin.
+
+    Args:
+        rng (random.Random): The random number generator
+        start (tuple): Where the road starts in meters
+        segments (int): The number of segments in the road
+
+    Returns:
+        (list): The coordinates of the road in meters
+    """
+    x, y = start
+    heading = rng.uniform(0, 2 * math.pi)
+    coords = [(x, y)]
+    for segment in range(segments):
+        heading += rng.uniform(-0.35, 0.35)
+        length = rng.uniform(50, 150)
+        x += length * math.cos(heading)
+        y += length * math.sin(heading)
+        coords.append((x, y))
+
+    return coords
+
+def offsetRoad(coords: list,
+               offset: float,
+               noise: float = 0.0,
+               rng: random.Random = None,
+               ) -> list:
+    """
+    Move a road sideways, like a road digitized from different imagery.
+
+    Args:
+        coords (list): The coordinates of the road in meters
+        offset (float): How far to move the road to the left in meters
+        noise (float): How far each point can also move randomly in meters
+        rng (random.Random): The random number generator for the noise
+
+    Returns:
+        (list): The moved coordinates in meters
+    """
+    (x1, y1), (x2, y2) = coords[0], coords[-1]
+    length = math.hypot(x2 - x1, y2 - y1) or 1.0
+    dx = -(y2 - y1) / length * offset
+    dy = (x2 - x1) / length * offset
+    moved = list()
+    for x, y in coords:
+        if noise > 0:
+            x += rng.uniform(-noise, noise)
+            y += rng.uniform(-noise, noise)
+        moved.append((x + dx, y + dy))
+
+    return moved
+
+def toDegrees(coords: list) -> LineString:
+    """
+    Convert a road in meters from the origin to a LineString in degrees.
+
+    Args:
+        coords (list): The coordinates of the road in meters
+
+    Returns:
+        (LineString): The road
+    """
+    scale = METERS * math.cos(math.radians(ORIGIN[1]))
+    return LineString([(round(ORIGIN[0] + x / scale, 7), round(ORIGIN[1] + y / METERS, 7)) for x, y in coords])
+
+def makeDatasets(seed: int,
+                 roads: int,
+                 density: float,
+                 offset: float = 3.0,
+                 ) -> tuple:
+    """
+    Make a synthetic secondary dataset like an OSM extract, and a
+    primary dataset like MVUM with most of the same roads. The primary
+    roads are moved sideways, use FR instead of FS for the reference,
+    and some have a different reference number. Some secondary roads
+    have a short spur road running parallel to them, and some primary
+    roads are new.
+
+    Args:
+        seed (int): The seed for the random number generator
+        roads (int): The number of roads in the secondary dataset
+        density (float): The number of roads for each square kilometer
+        offset (float): How far the primary roads are moved in meters
+
+    Returns:
+        (list): The primary features
+        (list): The secondary features
+        (list): The primary and secondary feature for each road in both
+    """
+    rng = random.Random(seed)
+    side = math.sqrt(roads / density) * 1000
+    primary = list()
+    secondary = list()
+    pairs = list()
+    osmid = 1
+    for index in range(roads):
+        start = (rng.uniform(0, side), rng.uniform(0, side))
+        coords = makeRoad(rng, start, rng.randint(5, 15))
+        number = f"{rng.randint(100, 999)}.{rng.randint(1, 9)}"
+        tags = {"id": osmid, "version": rng.randint(1, 5), "highway": rng.choice(["unclassified", "track"])}
+        osmid += 1
+        name = None
+        if rng.random() < 0.7:
+            name = f"{rng.choice(NAMES)} Road"
+            tags["name"] = name
+        tags["ref:usfs"] = f"FS {number}"
+        existing = Feature(geometry=toDegrees(coords), properties=tags)
+        secondary.append(existing)
+
+        # A parallel spur road, which is close but not the same road
+        if rng.random() < 0.2:
+            spur = offsetRoad(coords[:rng.randint(2, len(coords))], rng.uniform(10, 30))
+            tags = {"id": osmid, "version": 1, "highway": "track", "ref:usfs": f"FS {number}{rng.choice('ABC')}"}
+            osmid += 1
+            secondary.append(Feature(geometry=toDegrees(spur), properties=tags))
+
+        if rng.random() < 0.9:
+            tags = {"highway": "unclassified", "operator": "US Forest Service"}
+            if name is not None:
+                tags["name"] = name if rng.random() < 0.8 else name.upper()
+            if rng.random() < 0.1:
+                # The reference number changed
+                number = f"{rng.randint(100, 999)}.{rng.randint(1, 9)}"
+            tags["ref:usfs"] = f"FR {number}"
+            entry = Feature(geometry=toDegrees(offsetRoad(coords, offset, 1.0, rng)), properties=tags)
+            primary.append(entry)
+            pairs.append((entry, existing))
+
+    # Roads that aren't in OSM yet
+    for index in range(roads // 10):
+        start = (rng.uniform(0, side), rng.uniform(0, side))
+        tags = {"highway": "track", "name": f"{rng.choice(NAMES)} Spur", "ref:usfs": f"FR {rng.randint(1000, 1999)}"}
+        primary.append(Feature(geometry=toDegrees(makeRoad(rng, start, rng.randint(3, 8))), properties=tags))
+
+    return primary, secondary, pairs
+
+def timeCalls(function,
+              pairs: list,
+              repeat: int,
+              setup=None,
+              ) -> float:
+    """
+    Time a function on every pair of features, and use the fastest of
+    several tries so other things running on the machine matter less.
+
+    Args:
+        function (callable): The function to time, which gets both features
+        pairs (list): The primary and secondary features to call it with
+        repeat (int): How many times to try
+        setup (callable): Called before each try, and not timed
+
+    Returns:
+        (float): The time for each call in microseconds
+    """
+    best = math.inf
+    for attempt in range(repeat):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        for entry, existing in pairs:
+            function(entry, existing)
+        best = min(best, perf_counter() - start)
+
+    return 1e6 * best / max(len(pairs), 1)
+
+def runBenchmark(seed: int,
+                 roads: int,
+                 density: float,
+                 threshold: float,
+                 repeat: int,
+                 ) -> dict:
+    """
+    Run all the benchmarks on one synthetic dataset.
+
+    Args:
+        seed (int): The seed for the random number generator
+        roads (int): The number of roads in the secondary dataset
+        density (float): The number of roads for each square kilometer
+        threshold (float): Threshold for distance calculations in meters
+        repeat (int): How many times to try each benchmark
+
+    Returns:
+        (dict): The results
+    """
+    primary, secondary, pairs = makeDatasets(seed, roads, density)
+    conflate = Conflator()
+    result = {"roads": roads,
+              "density": density,
+              "primary": len(primary),
+              "secondary": len(secondary),
+              }
+    result["getDistance"] = timeCalls(conflate.getDistance, pairs, repeat)
+    result["getSlope"] = timeCalls(conflate.getSlope, pairs, repeat)
+    # Every try compares the same names, so only the first would miss
+    # the fuzzy matching cache. Time it with an empty cache, and then
+    # with the cache filled by the last try.
+    result["checkTags"] = timeCalls(conflate.checkTags, pairs, repeat, cachedRatio.cache_clear)
+    result["checkTagsWarm"] = timeCalls(conflate.checkTags, pairs, repeat)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        primaryspec = f"{tmpdir}/primary.geojson"
+        secondaryspec = f"{tmpdir}/secondary.geojson"
+        for filespec, features in ((primaryspec, primary), (secondaryspec, secondary)):
+            with open(filespec, "w") as file:
+                geojson.dump(FeatureCollection(features), file)
+        best = math.inf
+        for attempt in range(repeat):
+            start = perf_counter()
+            conflate.conflateData(primaryspec, secondaryspec, threshold)
+            best = min(best, perf_counter() - start)
+        result["conflateData"] = best
+
+    log.info(f"{roads} roads, {density}/km²: {result}")
+    return result
+
+def getCommit() -> str:
+    """
+    Get the commit being benchmarked.
+
+    Returns:
+        (str): The short hash of the commit, with -dirty if there are changes
+    """
+    toplevel = Path(__file__).parent
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=toplevel,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=toplevel,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    if status:
+        commit += "-dirty"
+
+    return commit
+
+def compareResults(before: dict,
+                   after: dict,
+                   ):
+    """
+    Print the results of two runs side by side.
+
+    Args:
+        before (dict): The results of the first run
+        after (dict): The results of the second run
+    """
+    if before["machine"] != after["machine"]:
+        log.warning("The results are from different machines!")
+    print(f"{'roads':>8} {'density':>8} {'benchmark':>14} {before['commit']:>14} {after['commit']:>14} {'change':>8}")
+    old = {(result["roads"], result["density"]): result for result in before["results"]}
+    for result in after["results"]:
+        key = (result["roads"], result["density"])
+        if key not in old:
+            continue
+        for name, unit in (("getDistance", "us"), ("getSlope", "us"), ("checkTags", "us"), ("checkTagsWarm", "us"), ("conflateData", "s")):
+            # Older results don't have every benchmark
+            if name not in old[key] or name not in result:
+                continue
+            first = old[key][name]
+            second = result[name]
+            print(f"{key[0]:>8} {key[1]:>8} {name:>14} {first:>12.3f}{unit:<2} {second:>12.3f}{unit:<2} {100 * (second - first) / first:>+7.1f}%")
+
+def main():
+    """This main function lets this class be run standalone by a bash script"""
+    parser = argparse.ArgumentParser(
+        prog="benchmark",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="This program benchmarks the conflation engine",
+        epilog="""
+This program generates synthetic highway datasets, and times getDistance(),
+getSlope(), checkTags() and a full conflateData() run on them. The results
+are saved in a JSON file named for the current commit, so a different
+commit can be compared on the same machine.
+
+    For Example:
+        benchmark.py -s 100,1000 -d 2,10
+        benchmark.py --compare a4e6203 1cf740f
+        """,
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="verbose output")
+    parser.add_argument("-s", "--sizes", default="100,1000", help="The number of roads in each dataset")
+    parser.add_argument("-d", "--densities", default="2,10", help="The number of roads for each square kilometer")
+    parser.add_argument("-e", "--seed", type=int, default=42, help="The seed for the random number generator")
+    parser.add_argument("-t", "--threshold", type=float, default=7.0, help="Threshold for distance calculations")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="How many times to try each benchmark")
+    parser.add_argument("-o", "--outdir", default=str(Path(__file__).parent / "results"), help="Where to save the results")
+    parser.add_argument("-c", "--compare", nargs=2, help="Compare the results from two commits")
+
+    args = parser.parse_args()
+
+    # if verbose, dump to the terminal.
+    log_level = os.getenv("LOG_LEVEL", default="INFO")
+    if args.verbose:
+        log_level = logging.DEBUG
+
+    logging.basicConfig(
+        level=log_level,
+        format=("%(asctime)s.%(msecs)03d [%(levelname)s] " "%(name)s | %(funcName)s:%(lineno)d | %(message)s"),
+        datefmt="%y-%m-%d %H:%M:%S",
+        stream=sys.stdout,
+    )
+
+    outdir = Path(args.outdir)
+    if args.compare:
+        runs = list()
+        for commit in args.compare:
+            path = Path(commit)
+            if not path.exists():
+                path = outdir / f"{commit}.json"
+            with open(path, "r") as file:
+                runs.append(json.load(file))
+        compareResults(runs[0], runs[1])
+        return
+
+    info = get_cpu_info()
+    report = {"commit": getCommit(),
+              "date": datetime.now(timezone.utc).isoformat(),
+              "machine": {"cpu": info.get("brand_raw"),
+                          "cores": info["count"],
+                          "python": platform.python_version(),
+                          },
+              "parameters": {"seed": args.seed,
+                             "threshold": args.threshold,
+                             "repeat": args.repeat,
+                             },
+              "results": list(),
+              }
+    for roads in [int(size) for size in args.sizes.split(",")]:
+        for density in [float(density) for density in args.densities.split(",")]:
+            report["results"].append(runBenchmark(args.seed, roads, density, args.threshold, args.repeat))
+
+    outdir.mkdir(parents=True, exist_ok=True)
+    outfile = outdir / f"{report['commit']}.json"
+    with open(outfile, "w") as file:
+        json.dump(report, file, indent=4)
+    log.info(f"Wrote {outfile}")
+
+if __name__ == "__main__":
+    """This is just a hook so this file can be run standlone during development."""
+    main()
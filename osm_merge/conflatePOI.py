@@ -39,7 +39,9 @@ from cpuinfo import get_cpu_info
 from time import sleep
 from haversine import haversine, Unit
 from thefuzz import fuzz, process
-from geosupport import GeoSupport
+import rapidfuzz
+import numpy
+from osm_merge.geosupport import GeoSupport
 
 
 # Instantiate logger
@@ -202,9 +204,49 @@ class ConflatePOI(object):
 
         return features
 
+    def getRatios(self,
+                  feature: Feature,
+                  entries: list,
+                  ) -> list:
+        """
+        Get the fuzzy match ratios between the tags of a feature and the
+        same tags in each of the query results, with one rapidfuzz cdist()
+        call for all of them. Ratios below the threshold are 0, as
+        checkTags() only needs to know whether it's a match.
+
+        Args:
+            feature (Feature): The feature from the external dataset
+            entries (list): The results of the SQL query from queryToFeature()
+
+        Returns:
+            (list): The ratio for each tag, for each of the results
+        """
+        match_threshold = 80
+        ratios = [dict() for entry in entries]
+        keys = [key for key, value in feature['tags'].items() if type(value) == str]
+        columns = dict()
+        for entry in entries:
+            for key in keys:
+                if type(entry['tags'].get(key)) == str:
+                    columns.setdefault(entry['tags'][key], len(columns))
+        if len(columns) == 0:
+            return ratios
+        scores = rapidfuzz.process.cdist([feature['tags'][key] for key in keys],
+                                         list(columns),
+                                         scorer=rapidfuzz.fuzz.ratio,
+                                         score_cutoff=match_threshold,
+                                         dtype=numpy.float64)
+        for ratio, entry in zip(ratios, entries):
+            for row, key in enumerate(keys):
+                if type(entry['tags'].get(key)) == str:
+                    ratio[key] = int(round(scores[row][columns[entry['tags'][key]]]))
+
+        return ratios
+
     def checkTags(self,
                   feature: Feature,
                   osm: dict,
+                  ratios: dict = None,
                   ):
         """
         Check tags between 2 features.
@@ -212,6 +254,7 @@ class ConflatePOI(object):
         Args:
             feature (Feature): The feature from the external dataset
             osm (dict): The result of the SQL query
+            ratios (dict): The fuzzy match ratios from getRatios(), if already done
 
         Returns:
             (int): The nunber of tag matches
@@ -224,7 +267,10 @@ class ConflatePOI(object):
             return 0, osm['tags']
         for key, value in feature['tags'].items():
             if key in tags:
-                ratio = fuzz.ratio(value, tags[key])
+                if ratios is not None and key in ratios:
+                    ratio = ratios[key]
+                else:
+                    ratio = fuzz.ratio(value, tags[key])
                 if ratio > match_threshold:
                     hits += 1
                 else:
@@ -436,8 +482,9 @@ def conflateThread(features: list,
         if len(results) > 1:
             log.warning(f"Got more than one result! Got {len(results)}")
 
-            for entry in cp.queryToFeature(results):
-                hits, tags = cp.checkTags(value, entry)
+            entries = cp.queryToFeature(results)
+            for entry, ratios in zip(entries, cp.getRatios(value, entries)):
+                hits, tags = cp.checkTags(value, entry, ratios)
                 log.debug(f"Got {hits} out of {len(tags)} matched for {tags}")
                 if hits > 0:
                     dups += 1
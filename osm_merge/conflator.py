@@ -20,14 +20,17 @@ import logging
 import sys
 import os
 import re
+import json
+import pickle
+import hashlib
 from sys import argv
 from osm_fieldwork.osmfile import OsmFile
 from geojson import Point, Feature, FeatureCollection, dump, Polygon, load
 import geojson
 from shapely.geometry import shape, LineString, MultiLineString, Polygon, mapping
 import shapely
-from shapely.ops import transform, nearest_points, linemerge
-from shapely import wkt
+from shapely.ops import nearest_points, linemerge
+from shapely import wkt, STRtree
 from progress.bar import Bar, PixelBar
 from progress.spinner import PixelSpinner
 from osm_fieldwork.convert import escape
@@ -37,9 +40,10 @@ import asyncio
 from codetiming import Timer
 import concurrent.futures
 from cpuinfo import get_cpu_info
-from time import sleep
+from time import sleep, perf_counter
 from haversine import haversine, Unit
 from thefuzz import fuzz, process
+import rapidfuzz
 from pathlib import Path
 from osm_fieldwork.parsers import ODKParsers
 from pathlib import Path
@@ -47,11 +51,20 @@ from pathlib import Path
 from osm_rawdata.pgasync import PostgresClient
 from tqdm import tqdm
 import tqdm.asyncio
-import xmltodict
+from xml.etree.ElementTree import iterparse, XMLPullParser
+import array as pyarray
+import osmium
 from numpy import arccos, array
 from numpy.linalg import norm
 import math
 import numpy
+from functools import cache, lru_cache
+from contextlib import contextmanager
+from osm_merge.featurestore import FeatureStore, FeatureRecord
+from osm_merge.nodecache import NodeCache
+from osm_merge.tagfilter import TagFilter
+from osm_merge.readjson import streamFeatures
+from osm_merge.runstore import RunStore
 
 # Instantiate logger
 log = logging.getLogger(__name__)
@@ -62,6 +75,26 @@ info = get_cpu_info()
 # still reasonable.
 cores = info['count']
 
+# The number of string pairs to keep in the fuzzy matching cache
+RATIO_CACHE_SIZE = 65536
+
+# The tags compared when conflating, and the fuzzy match ratio they
+# need to be considered the same
+MATCH_TAGS = ["name", "ref", "ref:usfs"]
+MATCH_THRESHOLD = 85
+
+# OSM XML files at least this big are parsed by multiple processes
+PARALLEL_SIZE = 64 * 1024 * 1024
+
+# The secondary dataset for the processes in a pool, and the most
+# recently prepared part of it.
+shared = None
+prepared = dict()
+
+# The number of calls and the time spent in each stage of the
+# conflation, or None when they aren't being recorded.
+timings = None
+
 # shut off warnings from pyproj
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -83,21 +116,858 @@ def hitsSort(data: list):
     """
     return data['hits']
 
+@contextmanager
+def stage(name: str):
+    """
+    Add the time spent in a stage of the conflation to the timings, if
+    they are being recorded.
+
+    Args:
+        name (str): The name of the stage
+    """
+    if timings is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        entry = timings.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += perf_counter() - start
+
+def addTimings(stages: dict):
+    """
+    Add the timings from a worker process to the ones for this process.
+
+    Args:
+        stages (dict): The number of calls and the time for each stage
+    """
+    for name, (count, seconds) in stages.items():
+        entry = timings.setdefault(name, [0, 0.0])
+        entry[0] += count
+        entry[1] += seconds
+
+@cache
+def getTransformer() -> pyproj.Transformer:
+    """
+    Get the transformer used to convert from degrees to meters. This
+    is cached as creating a new one is slow.
+
+    Returns:
+        (pyproj.Transformer): The transformer from EPSG:4326 to EPSG:3857
+    """
+    return pyproj.Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+
+@lru_cache(maxsize=RATIO_CACHE_SIZE)
+def cachedRatio(first: str,
+                second: str,
+                ) -> int:
+    """
+    Get the fuzzy match ratio of two strings. The same names and
+    refs get compared many times, so the results are cached.
+
+    Args:
+        first (str): The first string
+        second (str): The second string
+
+    Returns:
+        (int): The ratio from 0 to 100
+    """
+    return fuzz.ratio(first, second)
+
+def fuzzyRatio(first: str,
+               second: str,
+               ) -> int:
+    """
+    Get the fuzzy match ratio of two strings, ignoring case. The ratio
+    is the same either way around, so the pair is sorted to get more
+    hits in the cache. This is for comparing one pair at a time, like
+    the brute force search does. Otherwise conflateThread() scores the
+    whole batch at once with a RatioMatrix.
+
+    Args:
+        first (str): The first string
+        second (str): The second string
+
+    Returns:
+        (int): The ratio from 0 to 100
+    """
+    first = first.lower()
+    second = second.lower()
+    if second < first:
+        return cachedRatio(second, first)
+    return cachedRatio(first, second)
+
+def normalizeRef(ref: str) -> str:
+    """
+    Get the reference number from a ref:usfs value, so "FR 123.4a"
+    and "FS 123.4A" are the same.
+
+    Args:
+        ref (str): The ref:usfs value
+
+    Returns:
+        (str): The reference number in upper case
+    """
+    tmp = ref.split(' ')
+    if len(tmp) > 1:
+        return tmp[1].upper()
+    return tmp[0].upper()
+
+def projectCoords(coords: numpy.ndarray) -> numpy.ndarray:
+    """
+    Transform an array of coordinates from degrees to meters.
+
+    Args:
+        coords (numpy.ndarray): The array of lon/lat coordinates
+
+    Returns:
+        (numpy.ndarray): The coordinates in meters
+    """
+    x, y = getTransformer().transform(coords[:, 0], coords[:, 1])
+    return numpy.column_stack((x, y))
+
+def projectGeometries(features: list) -> numpy.ndarray:
+    """
+    Convert the geometry of every feature to a shapely geometry in
+    meters. All the coordinates are transformed in a single call, so
+    this is much faster than doing each feature separately.
+
+    Args:
+        features (list): The features to project, or a FeatureStore
+
+    Returns:
+        (numpy.ndarray): The projected geometries, in the same order as the features
+    """
+    if isinstance(features, FeatureStore):
+        if "projected" in features.arrays:
+            return features.projected()
+        return shapely.transform(features.geometries(), projectCoords)
+    geoms = numpy.empty(len(features), dtype=object)
+    for index, feature in enumerate(features):
+        if feature["geometry"] is not None:
+            geoms[index] = shape(feature["geometry"])
+    return shapely.transform(geoms, projectCoords)
+
+def getEndpoints(geoms: numpy.ndarray) -> numpy.ndarray:
+    """
+    Get the points getSlope() uses to calculate the slope of each
+    geometry, which are the third point from each end of a LineString.
+
+    Args:
+        geoms (numpy.ndarray): The projected geometries
+
+    Returns:
+        (numpy.ndarray): The number of points, and the x and y of the start
+            and end for each geometry. Missing points are NaN.
+    """
+    points = shapely.get_num_points(geoms)
+    start = shapely.get_point(geoms, 2)
+    end = shapely.get_point(geoms, points - 2)
+    return numpy.column_stack((points,
+                               shapely.get_x(start),
+                               shapely.get_y(start),
+                               shapely.get_x(end),
+                               shapely.get_y(end),
+                               ))
+
+def partitionData(primary: list,
+                  secondary: list,
+                  threshold: float,
+                  tiles: int,
+                  ) -> list:
+    """
+    Split the primary dataset into spatial tiles, and get the secondary
+    features each tile needs. Each primary feature goes in the tile
+    its center is in, and only the secondary features within the
+    threshold distance of the primary features in that tile are
+    included, so each process only gets the data it needs.
+
+    Args:
+        primary (list): The external dataset to conflate
+        secondary (list): The secondary dataset, probably existing OSM data
+        threshold (float): Threshold for distance calculations in meters
+        tiles (int): The approximate number of tiles to split the data into
+
+    Returns:
+        (list): The indexes of the primary and secondary features for each tile
+    """
+    bounds = shapely.bounds(projectGeometries(primary))
+    oldgeoms = projectGeometries(secondary)
+    # Nodes are never conflated against, so aren't needed
+    points = shapely.get_type_id(oldgeoms) == shapely.GeometryType.POINT
+    tree = STRtree(numpy.where(points, None, oldgeoms))
+
+    # Use a grid over the center of every primary feature.
+    x = numpy.nan_to_num((bounds[:, 0] + bounds[:, 2]) / 2)
+    y = numpy.nan_to_num((bounds[:, 1] + bounds[:, 3]) / 2)
+    columns = math.ceil(math.sqrt(tiles))
+    rows = math.ceil(tiles / columns)
+    width = max(x.max() - x.min(), 1.0) / columns
+    height = max(y.max() - y.min(), 1.0) / rows
+    column = numpy.minimum(((x - x.min()) / width).astype(int), columns - 1)
+    row = numpy.minimum(((y - y.min()) / height).astype(int), rows - 1)
+    grid = row * columns + column
+
+    blocks = list()
+    for tile in numpy.unique(grid):
+        indexes = numpy.flatnonzero(grid == tile)
+        # The features may extend outside the tile, so use the extent
+        # of the features themselves plus the threshold as a halo.
+        minx, miny = numpy.nanmin(bounds[indexes, :2], axis=0) - threshold
+        maxx, maxy = numpy.nanmax(bounds[indexes, 2:], axis=0) + threshold
+        nearby = numpy.sort(tree.query(shapely.box(minx, miny, maxx, maxy)))
+        blocks.append((indexes, nearby))
+
+    log.debug(f"Split the data into {len(blocks)} tiles, averaging {sum(len(block[1]) for block in blocks) / len(blocks):.0f} secondary features each")
+    return blocks
+
+class LazyGeometries(object):
+    def __init__(self,
+                 secondary: list,
+                 ):
+        """
+        This class has the secondary geometries in meters, but for a
+        FeatureStore they're only built when they are first used. Until
+        then only the bounding boxes are needed, so the ones that are
+        never near a primary feature are never built. Once built, a
+        geometry is kept for the other primary features.
+
+        Args:
+            secondary (list): The secondary dataset, or a FeatureStore
+
+        Returns:
+            (LazyGeometries): An instance of this object
+        """
+        self.store = None
+        if isinstance(secondary, FeatureStore):
+            self.store = secondary
+            self.types = secondary.types().astype(numpy.int64)
+            self.geoms = numpy.empty(len(secondary), dtype=object)
+            self.ends = numpy.full((len(secondary), 5), numpy.nan)
+            self.built = numpy.zeros(len(secondary), dtype=bool)
+            # Web Mercator keeps the longitude and latitude separate, so
+            # the corners of the box are the corners of the projected one.
+            bounds = secondary.bounds()
+            bounds = numpy.hstack([projectCoords(bounds[:, 0:2]), projectCoords(bounds[:, 2:4])])
+        else:
+            self.geoms = projectGeometries(secondary)
+            self.types = shapely.get_type_id(self.geoms)
+            self.ends = getEndpoints(self.geoms)
+            self.built = numpy.ones(len(secondary), dtype=bool)
+            bounds = shapely.bounds(self.geoms)
+        finite = numpy.isfinite(bounds).all(axis=1)
+        self.boxes = numpy.empty(len(bounds), dtype=object)
+        self.boxes[finite] = shapely.box(*bounds[finite].T)
+
+    def build(self,
+              indexes: numpy.ndarray,
+              ):
+        """
+        Build the geometries that haven't been used yet.
+
+        Args:
+            indexes (numpy.ndarray): The features to build
+        """
+        indexes = numpy.atleast_1d(indexes)
+        missing = indexes[~self.built[indexes]]
+        if len(missing) == 0:
+            return
+        missing = numpy.unique(missing)
+        if "projected" in self.store.arrays:
+            geoms = self.store.projected(missing)
+        else:
+            geoms = shapely.transform(self.store.geometries(missing), projectCoords)
+        self.geoms[missing] = geoms
+        self.ends[missing] = getEndpoints(geoms)
+        self.built[missing] = True
+
+    def __getitem__(self,
+                    indexes: numpy.ndarray,
+                    ) -> numpy.ndarray:
+        """
+        Args:
+            indexes (numpy.ndarray): The features to get
+
+        Returns:
+            (numpy.ndarray): The geometries in meters
+        """
+        self.build(indexes)
+        return self.geoms[indexes]
+
+    def endpoints(self,
+                  indexes: numpy.ndarray,
+                  ) -> numpy.ndarray:
+        """
+        Get the points used to calculate the slope and angle.
+
+        Args:
+            indexes (numpy.ndarray): The features to get
+
+        Returns:
+            (numpy.ndarray): The endpoints from getEndpoints()
+        """
+        self.build(indexes)
+        return self.ends[indexes]
+
+class RatioMatrix(object):
+    def __init__(self,
+                 features: list,
+                 records: list,
+                 ):
+        """
+        This class has the fuzzy match ratios of the tags checkTags()
+        compares, between a batch of primary features and all the
+        secondary features any of them might match. The values are lower
+        cased and each distinct value is only used once, then each tag
+        is scored with one rapidfuzz cdist() call, which is what thefuzz
+        does one pair at a time. Ratios below the threshold for a match
+        are 0, as checkTags() doesn't use them.
+
+        Every pair in the matrix is scored once, so this doesn't use the
+        fuzzyRatio() cache. That is for the brute force search, which
+        compares one pair at a time.
+
+        Args:
+            features (list): The primary features
+            records (list): The FeatureRecords of the secondary features
+
+        Returns:
+            (RatioMatrix): An instance of this object
+        """
+        self.rows = dict()
+        self.columns = dict()
+        self.scores = dict()
+        for key in MATCH_TAGS:
+            rows = dict()
+            for feature in features:
+                value = feature["properties"].get(key)
+                if type(value) == str:
+                    rows.setdefault(value.lower(), len(rows))
+            columns = dict()
+            for record in records:
+                value = record.tags.get(key)
+                if type(value) == str:
+                    columns.setdefault(value.lower(), len(columns))
+            if not rows or not columns:
+                continue
+            scores = rapidfuzz.process.cdist(list(rows), list(columns),
+                                             scorer=rapidfuzz.fuzz.ratio,
+                                             score_cutoff=MATCH_THRESHOLD,
+                                             dtype=numpy.float64)
+            # Round halves to even like thefuzz does, and the ratios
+            # are never more than 100.
+            self.scores[key] = numpy.rint(scores).astype(numpy.uint8)
+            self.rows[key] = rows
+            self.columns[key] = columns
+
+    def ratios(self,
+               feature: Feature,
+               records: list,
+               ) -> list:
+        """
+        Get the ratios between one of the primary features and some of
+        the secondary features.
+
+        Args:
+            feature (Feature): One of the primary features
+            records (list): The FeatureRecords to get the ratios for
+
+        Returns:
+            (list): The ratio for each tag, for each of the records
+        """
+        ratios = [dict() for record in records]
+        for key, scores in self.scores.items():
+            value = feature["properties"].get(key)
+            if type(value) != str:
+                continue
+            row = scores[self.rows[key][value.lower()]]
+            columns = self.columns[key]
+            for position, record in enumerate(records):
+                choice = record.tags.get(key)
+                if type(choice) == str:
+                    ratios[position][key] = int(row[columns[choice.lower()]])
+
+        return ratios
+
+def prepareSecondary(secondary: list,
+                     bruteforce: bool = False,
+                     ) -> dict:
+    """
+    Transform the secondary dataset to meters, and load the bounding
+    boxes into a spatial index so only the features near each primary
+    feature get compared. Nodes are never conflated against, so they
+    aren't added to the index.
+
+    Args:
+        secondary (list): The secondary dataset, or a FeatureStore
+        bruteforce (bool): Don't bother with the spatial index
+
+    Returns:
+        (dict): The projected geometries as LazyGeometries, the spatial
+            index, the features for each ref:usfs reference number, and
+            a FeatureRecord for each feature
+    """
+    with stage("projection"):
+        geoms = LazyGeometries(secondary)
+    types = geoms.types
+    records = makeRecords(secondary, types)
+    tree = None
+    refs = dict()
+    if not bruteforce:
+        with stage("candidates"):
+            points = types == shapely.GeometryType.POINT
+            tree = STRtree(numpy.where(points, None, geoms.boxes))
+
+            # Most forest roads have a ref:usfs, so also index the
+            # features by the reference number.
+            if isinstance(secondary, FeatureStore):
+                values = secondary.tagValues("ref:usfs")
+            else:
+                values = [feature["properties"].get("ref:usfs") for feature in secondary]
+            for index, value in enumerate(values):
+                if type(value) == str and not points[index]:
+                    refs.setdefault(normalizeRef(value), list()).append(index)
+
+    return {"geoms": geoms, "tree": tree, "refs": refs, "records": records}
+
+def makeRecords(secondary: list,
+                types: numpy.ndarray,
+                ) -> list:
+    """
+    Get a FeatureRecord for each secondary feature, with only what's
+    needed to decide if it matches.
+
+    Args:
+        secondary (list): The secondary dataset, or a FeatureStore
+        types (numpy.ndarray): The shapely geometry type ID of each feature
+
+    Returns:
+        (list): The records
+    """
+    if isinstance(secondary, FeatureStore):
+        return secondary.records(MATCH_TAGS)
+
+    records = list()
+    for index, (feature, geomtype) in enumerate(zip(secondary, types)):
+        properties = feature["properties"]
+        tags = {key: properties[key] for key in MATCH_TAGS if key in properties}
+        refs = properties.get("refs")
+        if type(refs) == list:
+            refs = numpy.array(refs, dtype=numpy.int64)
+        records.append(FeatureRecord(index, properties.get("id"), properties.get("version"), int(geomtype),
+                                     len(properties), tags, refs))
+
+    return records
+
+def initWorker(secondary,
+               timing: bool = False,
+               ):
+    """
+    Initialize a process in the pool with the secondary dataset, so
+    it only has to be sent once to each process.
+
+    Args:
+        secondary (list|FeatureStore|dict): The secondary features, or
+            the shared memory from FeatureStore.share()
+        timing (bool): Whether to record how long each stage takes
+    """
+    global shared, timings
+    timings = dict() if timing else None
+    if isinstance(secondary, dict):
+        shared = FeatureStore.attach(secondary)
+    else:
+        shared = secondary
+
+def conflateBatch(number: int,
+                  tile: int,
+                  primary: list,
+                  indexes: numpy.ndarray,
+                  informal: bool = False,
+                  threshold: float = 7.0,
+                  bruteforce: bool = False,
+                  ) -> tuple:
+    """
+    Conflate a batch of features against the secondary dataset from
+    initWorker(). Batches from the same tile use the same secondary
+    features, so the last one prepared is reused.
+
+    Args:
+        number (int): The batch number
+        tile (int): The tile the batch is in
+        primary (list): The external features to conflate
+        indexes (numpy.ndarray): The secondary features for the tile, or None for all of them
+        informal (bool): Whether to dump features in OSM not in external data
+        threshold (float): Threshold for distance calculations
+        bruteforce (bool): Compare against every feature instead of using a spatial index
+
+    Returns:
+        (int): The batch number
+        (dict): The process ID, the wall time in seconds, the fuzzy
+            matching cache statistics for the process, and the stage
+            timings for the batch if they're being recorded
+        (list):  The conflated output, the new features, and where the
+            output for each primary feature starts in them
+    """
+    start = perf_counter()
+    secondary = shared
+    if indexes is not None:
+        if isinstance(shared, FeatureStore):
+            secondary = shared.select(indexes)
+        else:
+            secondary = [shared[index] for index in indexes]
+    if prepared.get("tile") != tile:
+        prepared.clear()
+        prepared.update(prepareSecondary(secondary, bruteforce))
+        prepared["tile"] = tile
+    spans = list()
+    result = conflateThread(primary, secondary, informal, threshold, bruteforce=bruteforce, prepared=prepared, spans=spans)
+    result.append(spans)
+
+    stats = {"pid": os.getpid(),
+             "seconds": perf_counter() - start,
+             "cache": cachedRatio.cache_info()._asdict(),
+             }
+    if timings is not None:
+        stats["timings"] = dict(timings)
+        timings.clear()
+    return number, stats, result
+
+class Batches(object):
+    def __init__(self,
+                 tiles: list,
+                 workers: int,
+                 seconds: float = 2.0,
+                 ):
+        """
+        Split the primary features into batches to hand out to the
+        processes. The size of each batch adapts to how fast the
+        previous ones were, so they all take roughly the same time, and
+        get smaller at the end so all the processes finish together.
+
+        Args:
+            tiles (list): The indexes of the primary and secondary features for each tile
+            workers (int): The number of processes
+            seconds (float): How long each batch should take
+
+        Returns:
+            (Batches): An instance of this object
+        """
+        self.tiles = tiles
+        self.workers = workers
+        self.seconds = seconds
+        self.tile = 0
+        self.offset = 0
+        self.number = 0
+        self.remaining = sum(len(tile[0]) for tile in tiles)
+        # Start small until we know how fast the batches are
+        self.size = 16
+        self.rate = None
+        self.times = list()
+        self.busy = dict()
+        self.caches = dict()
+
+    def next(self) -> tuple:
+        """
+        Get the next batch.
+
+        Returns:
+            (int): The batch number
+            (int): The tile the batch is in
+            (numpy.ndarray): The indexes of the primary features
+            (numpy.ndarray): The indexes of the secondary features, or None for all
+        """
+        while self.tile < len(self.tiles) and self.offset >= len(self.tiles[self.tile][0]):
+            self.tile += 1
+            self.offset = 0
+        if self.tile >= len(self.tiles):
+            return None
+
+        size = min(self.size, math.ceil(self.remaining / (self.workers * 2)))
+        primary, secondary = self.tiles[self.tile]
+        batch = primary[self.offset:self.offset + max(size, 1)]
+        self.offset += len(batch)
+        self.remaining -= len(batch)
+        self.number += 1
+
+        return self.number, self.tile, batch, secondary
+
+    def update(self,
+               number: int,
+               count: int,
+               stats: dict,
+               ):
+        """
+        Record how long a batch took, and adjust the size of the next ones.
+
+        Args:
+            number (int): The batch number
+            count (int): The number of features in the batch
+            stats (dict): The statistics from conflateBatch()
+        """
+        pid = stats["pid"]
+        seconds = stats["seconds"]
+        log.debug(f"Batch {number} of {count} features took {seconds:.2f}s in process {pid}")
+        self.times.append(seconds)
+        self.busy[pid] = self.busy.get(pid, 0.0) + seconds
+        # The cache statistics are the total for the process so far
+        self.caches[pid] = stats["cache"]
+        rate = count / max(seconds, 0.001)
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate = (self.rate + rate) / 2
+        self.size = min(max(int(self.rate * self.seconds), 1), 10000)
+
+    def report(self):
+        """
+        Log how well the work was balanced between the processes.
+        """
+        if len(self.times) == 0:
+            return
+        times = numpy.array(self.times)
+        log.info(f"{len(times)} batches took {times.min():.2f}s minimum, {numpy.median(times):.2f}s median, {times.max():.2f}s maximum")
+        busy = numpy.array(list(self.busy.values()))
+        log.info(f"{len(busy)} processes were busy for {busy.min():.1f}s to {busy.max():.1f}s")
+        hits = sum(cache["hits"] for cache in self.caches.values())
+        misses = sum(cache["misses"] for cache in self.caches.values())
+        if hits + misses > 0:
+            full = max(cache["currsize"] for cache in self.caches.values())
+            log.info(f"The fuzzy matching cache had {hits} hits and {misses} misses, {100 * hits / (hits + misses):.1f}% hit rate, up to {full} of {RATIO_CACHE_SIZE} entries used")
+
+class ResultWriter(object):
+    def __init__(self,
+                 conflate,
+                 outfile: str,
+                 ):
+        """
+        This class writes the conflated features to the output files as
+        each batch finishes, instead of keeping them all in memory until
+        the end.
+
+        Args:
+            conflate (Conflator): The conflator, which does the OSM XML output
+            outfile (str): The output file name
+
+        Returns:
+            (ResultWriter): An instance of this object
+        """
+        self.conflate = conflate
+        self.osmout = outfile.replace(".geojson", "-out.osm")
+        self.jsonout = outfile.replace(".geojson", "-out.geojson")
+        self.newout = outfile.replace(".geojson", "-new.geojson")
+        self.osm = OsmFile(self.osmout)
+        self.files = list()
+        self.counts = list()
+        for filespec in (self.jsonout, self.newout):
+            file = open(filespec, "w")
+            file.write('{\n    "type": "FeatureCollection",\n    "features": [')
+            self.files.append(file)
+            self.counts.append(0)
+
+    def write(self,
+              data: list,
+              new: list,
+              ):
+        """
+        Write a batch of conflated features.
+
+        Args:
+            data (list): The conflated features
+            new (list): The features only in the primary dataset
+        """
+        # writeOSM() removes the OSM attributes from the tags, and
+        # those aren't in the GeoJson output either.
+        self.conflate.writeOSMFeatures(self.osm, data)
+        for index, features in enumerate((data, new)):
+            for feature in features:
+                text = geojson.dumps(feature, indent=4).replace("\n", "\n        ")
+                if self.counts[index] > 0:
+                    self.files[index].write(",")
+                self.files[index].write(f"\n        {text}")
+                self.counts[index] += 1
+
+    def close(self):
+        """
+        Finish writing all of the output files.
+        """
+        self.osm.footer()
+        log.info(f"Wrote {self.osmout}")
+        for file, count in zip(self.files, self.counts):
+            if count > 0:
+                file.write("\n    ")
+            file.write("]\n}")
+            file.close()
+        log.info(f"Wrote {self.jsonout}")
+        log.info(f"Wrote {self.newout}")
+
+class Checkpoint(object):
+    def __init__(self,
+                 directory: str,
+                 primaryspec: str,
+                 secondaryspec: str,
+                 threshold: float,
+                 informal: bool,
+                 bruteforce: bool,
+                 tagfilter: TagFilter = None,
+                 ):
+        """
+        This class saves each finished batch, so if the conflation gets
+        interrupted, running it again only does the remaining work. The
+        batches are kept in a subdirectory for the input files and the
+        options that change the results, so a different run never uses
+        them.
+
+        Args:
+            directory (str): The directory for the checkpoints
+            primaryspec (str): The primary dataset filespec
+            secondaryspec (str): The secondary dataset filespec
+            threshold (float): Threshold for distance calculations in meters
+            informal (bool): Whether to dump features in OSM not in external data
+            bruteforce (bool): Whether every feature is compared
+            tagfilter (TagFilter): The filter for the secondary features
+
+        Returns:
+            (Checkpoint): An instance of this object
+        """
+        key = hashlib.sha256()
+        for filespec in (primaryspec, secondaryspec):
+            with open(filespec, "rb") as file:
+                while block := file.read(1 << 20):
+                    key.update(block)
+            key.update(b"\0")
+        config = tagfilter.config if tagfilter is not None else None
+        key.update(json.dumps([float(threshold), bool(informal), bool(bruteforce), config], sort_keys=True).encode("utf-8"))
+        self.directory = Path(directory) / key.hexdigest()[:16]
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def load(self):
+        """
+        Load all the batches that have been finished, one at a time.
+
+        Returns:
+            (generator): The primary indexes, conflated features, new features,
+                and where each primary feature's output starts for each batch
+        """
+        batches = sorted(self.directory.glob("batch-*.pickle"))
+        if batches:
+            log.info(f"Loading {len(batches)} finished batches from {self.directory}")
+        for filespec in batches:
+            with open(filespec, "rb") as file:
+                batch = pickle.load(file)
+            yield batch["indexes"], batch["data"], batch["new"], batch["spans"]
+
+    def save(self,
+             indexes: list,
+             data: list,
+             new: list,
+             spans: list,
+             ):
+        """
+        Save a finished batch. It's written to a temporary file first,
+        so a batch is either saved completely or not at all. The batch
+        is pickled, as the conflated and new features can share the same
+        tags, and the output files depend on that.
+
+        Args:
+            indexes (list): The indexes of the primary features in the batch
+            data (list): The conflated features
+            new (list): The features only in the primary dataset
+            spans (list): Where the output for each primary feature starts in data and new
+        """
+        indexes = [int(index) for index in indexes]
+        filespec = self.directory / f"batch-{indexes[0]:09d}.pickle"
+        tmpfile = filespec.with_suffix(".tmp")
+        with open(tmpfile, "wb") as file:
+            pickle.dump({"indexes": indexes, "data": data, "new": new, "spans": spans}, file)
+        os.replace(tmpfile, filespec)
+
+class DataCache(object):
+    def __init__(self,
+                 directory: str,
+                 filespec: str,
+                 tagfilter: TagFilter = None,
+                 ):
+        """
+        This class keeps a parsed dataset as a FeatureStore in binary
+        files, with the geometries in meters, so the next run with the
+        same file can memory map it instead of parsing the file again.
+        Each file gets a subdirectory from its path, size, modification
+        time and contents, so a changed file is always parsed again.
+
+        Args:
+            directory (str): The directory for the cached datasets
+            filespec (str): The data file
+            tagfilter (TagFilter): The filter used when parsing the file
+
+        Returns:
+            (DataCache): An instance of this object
+        """
+        path = Path(filespec).resolve()
+        stat = path.stat()
+        contents = hashlib.sha256()
+        with open(path, "rb") as file:
+            while block := file.read(1 << 20):
+                contents.update(block)
+        config = tagfilter.config if tagfilter is not None else None
+        key = hashlib.sha256(json.dumps([str(path), stat.st_size, stat.st_mtime_ns,
+                                         contents.hexdigest(), config], sort_keys=True).encode("utf-8"))
+        self.directory = Path(directory) / key.hexdigest()[:16]
+
+    def load(self) -> FeatureStore:
+        """
+        Get the dataset, if it's been cached.
+
+        Returns:
+            (FeatureStore): The dataset, or None if it's not cached
+        """
+        if not (self.directory / "arrays.json").exists():
+            return None
+        log.debug(f"Using the cached dataset in {self.directory}")
+        return FeatureStore.load(self.directory)
+
+    def save(self,
+             data: list,
+             ):
+        """
+        Cache the parsed dataset.
+
+        Args:
+            data (list): The features from the file
+        """
+        store = FeatureStore(data, projectGeometries(data))
+        store.save(self.directory)
+        log.debug(f"Cached the dataset in {self.directory}")
+
 def conflateThread(primary: list,
                    secondary: list,
                    informal: bool = False,
                    threshold: float = 7.0,
                    spellcheck: bool = True,
+                   bruteforce: bool = False,
+                   prepared: dict = None,
+                   spans: list = None,
                    ) -> list:
     """
     Conflate features from ODK against all the features in OSM.
 
+    The brute force search also copies every node in the secondary
+    dataset to the conflated output, once for each primary feature. The
+    spatial index has no nodes in it, so they aren't copied otherwise.
+    The OSM XML output doesn't change, as nodes aren't written to it.
+
     Args:
         primary (list): The external dataset to conflate
-        seconday (list): The secondzry dataset, probably existing OSM data
+        seconday (list): The secondzry dataset, probably existing OSM data, which
+            may also be a FeatureStore
         threshold (int): Threshold for distance calculations
         informal (bool): Whether to dump features in OSM not in external data
         spellcheck (bool): Whether to also spell check string values
+        bruteforce (bool): Compare against every feature instead of using a spatial index
+        prepared (dict): The secondary dataset from prepareSecondary(), if already done
+        spans (list): If given, where the output for each primary feature
+            starts in the conflated and new features is added to it
 
     Returns:
         (list):  The conflated output
@@ -128,12 +998,73 @@ def conflateThread(primary: list,
 
     log.info(f"The primary dataset has {len(primary)} entries")
     log.info(f"The secondary dataset has {len(secondary)} entries")
-    
+
+    # Transform both datasets to meters once, and keep the geometries
+    # in the same order as the features so the distance and angle
+    # calculations can reuse them.
+    with stage("projection"):
+        newgeoms = projectGeometries(primary)
+        newends = getEndpoints(newgeoms)
+    if prepared is None:
+        prepared = prepareSecondary(secondary, bruteforce)
+    oldgeoms = prepared["geoms"]
+    tree = prepared["tree"]
+    refindex = prepared["refs"]
+    records = prepared["records"]
+
+    def nearby(newobj, refs: numpy.ndarray) -> tuple:
+        # If any features with exactly the same reference number are
+        # close enough, only those are used.
+        candidates = None
+        if refs is not None:
+            with stage("candidates"):
+                candidates = refs
+            with stage("distance"):
+                dists = cutils.getDistances(newobj, oldgeoms[candidates])
+            if not (dists <= threshold).any():
+                candidates = refs = None
+        if candidates is None:
+            # Only the features whose bounding box is within the
+            # threshold distance can match, and keeping them in the
+            # same order as the secondary dataset produces the same
+            # results as the brute force comparison.
+            with stage("candidates"):
+                minx, miny, maxx, maxy = newobj.bounds
+                envelope = shapely.box(minx - threshold, miny - threshold, maxx + threshold, maxy + threshold)
+                candidates = numpy.sort(tree.query(envelope))
+            # Get all the distances at once
+            with stage("distance"):
+                dists = cutils.getDistances(newobj, oldgeoms[candidates])
+        # Drop everything that is too far away.
+        close = dists <= threshold
+        return candidates[close], dists[close], refs
+
+    # Find the candidates for every primary feature first, so the tags
+    # of the whole batch can be scored at once.
+    found = [None] * len(primary)
+    if tree is not None:
+        for position, (entry, newobj) in enumerate(zip(primary, newgeoms)):
+            if entry["geometry"]["type"] == "Point":
+                continue
+            refs = None
+            ref = entry["properties"].get("ref:usfs")
+            if type(ref) == str and normalizeRef(ref) in refindex:
+                refs = numpy.array(refindex[normalizeRef(ref)], dtype=numpy.int64)
+            found[position] = nearby(newobj, refs)
+        with stage("tags"):
+            indexes = set()
+            for item in found:
+                if item is not None:
+                    indexes.update(item[0].tolist())
+            matrix = RatioMatrix(primary, [records[index] for index in sorted(indexes)])
+
     # Progress bar
     pbar = tqdm.tqdm(primary)
-    for entry in pbar:
+    for entry, newobj, newpoints, first in zip(pbar, newgeoms, newends, found):
         # for entry in primary:
         i += 1
+        if spans is not None:
+            spans.append((len(data), len(newdata)))
         # timer.start()
         confidence = 0
         maybe = list()
@@ -142,132 +1073,182 @@ def conflateThread(primary: list,
         if entry["geometry"]["type"] == "Point":
             continue
 
-        for existing in secondary:
-            odktags = dict()
-            osmtags = dict()
-            feature = dict()
-            newtags = dict()
-            # log.debug(f"ENTRY: {entry["properties"]}")
-            # log.debug(f"EXISTING: {existing["properties"]}")
-            if existing["geometry"] is not None:
-                if existing["geometry"]["type"] == "Point":
-                    data.append(existing)
+        start = len(data)
+        refs = None
+        while True:
+            dists = None
+            ratios = None
+            if tree is None:
+                candidates = range(len(secondary))
+            else:
+                if first is not None:
+                    candidates, dists, refs = first
+                    first = None
+                    with stage("tags"):
+                        ratios = matrix.ratios(entry, [records[index] for index in candidates])
+                else:
+                    # The features with the same reference number didn't
+                    # match, so everything nearby is checked after all.
+                    candidates, dists, refs = nearby(newobj, None)
+                    with stage("tags"):
+                        ratios = cutils.getRatios(entry, [records[index] for index in candidates])
+                with stage("slope"):
+                    slopes, angles = cutils.getSlopes(newpoints, oldgeoms.endpoints(candidates))
+
+            for position, index in enumerate(candidates):
+                record = records[index]
+                odktags = dict()
+                osmtags = dict()
+                feature = dict()
+                newtags = dict()
+                if record.geomtype == shapely.GeometryType.POINT:
+                    # Only happens for the brute force search
+                    data.append(secondary[index])
                     continue
-            geom = None
-            # We could probably do this using GeoPandas or gdal, but that's
-            # going to do the same brute force thing anyway.
-
-            # If the input file is in OSM XML format, we don't want to
-            # conflate the nodes with no tags. They are used to build
-            # the geometry for the way, and after that aren't needed anymore.
-            # If the node has tags, then it's a POI, which we do conflate.
-            # log.debug(entry)
-            if entry["geometry"] is None or existing["geometry"] is None:
-                # Obviously can't do a distance comparison is a geometry is missing
-                continue
-            if entry["geometry"]["type"] == "Point" and len(entry["properties"]) <= 2:
-                continue
-            if existing["geometry"]["type"] == "Point" and len(existing["properties"]) <= 2:
-                continue
-
-            dist = float()
-            slope = float()
-            hits = 0
-
-            try:
-                dist = cutils.getDistance(entry, existing)
-            except:
-                log.error(f"getDistance() just had a weird error")
-                log.error(f"ENTRY: {entry["properties"]}")
-                log.error(f"EXISTING: {existing["properties"]}")
-                # breakpoint()
-                continue
-
-            # log.debug(f"ENTRY: {dist}: {entry["properties"]}")
-            # log.debug(f"EXISTING: {existing["properties"]}")
-            if dist <= threshold:
-                if "id" not in existing["properties"]:
-                    existing["properties"]["id"] = -1
-                angle = 0.0
-                try:
-                    slope, angle = cutils.getSlope(entry, existing)
-                except:
-                    log.error(f"getSlope() just had a weird error")
-                    log.error(f"ENTRY: {entry["properties"]}")
-                    log.error(f"EXISTING: {existing["properties"]}")
-                    # breakpoint()
-                    # slope, angle = cutils.getSlope(entry, existing)
-                    break
-                # log.debug(f"DIST: {dist}, ANGLE: {angle}, SLOPE: {slope}")
-                # log.debug(f"PRIMARY: {entry["properties"]}")
-                # log.debug(f"SECONDARY: {existing["properties"]}")
-                hits, tags = cutils.checkTags(entry, existing)
-                # log.debug(f"HITS2: {hits}")
-                angle_threshold = 20.0
-                slope_threshold = 4.0
-                name1 = None
-                name2 = None
-                if "name" in existing["properties"]:
-                    name2 = existing["properties"]["name"]
-                if "name" in entry["properties"]:
-                    name1 = entry["properties"]["name"]
-                # log.debug(f"DIST: {dist}, SLOPE: {slope:.3f}, Angle: {angle:.3f} - {name1} == {name2}")
-                if hits == 0 and (abs(angle) > angle_threshold or abs(slope) > slope_threshold):
+                geom = None
+                # We could probably do this using GeoPandas or gdal, but that's
+                # going to do the same brute force thing anyway.
+
+                # If the input file is in OSM XML format, we don't want to
+                # conflate the nodes with no tags. They are used to build
+                # the geometry for the way, and after that aren't needed anymore.
+                # If the node has tags, then it's a POI, which we do conflate.
+                # log.debug(entry)
+                if entry["geometry"] is None or record.geomtype < 0:
+                    # Obviously can't do a distance comparison is a geometry is missing
                     continue
-                if hits == 1 and abs(angle) < 15 and abs(slope) < 1:
-                    log.debug(f"Name matched, not geom")
-                    log.error(f"ENTRY: {entry["properties"]}")
-                    log.error(f"EXISTING: {existing["properties"]["id"]}")
-                    # FIXME parallel roads
-                    break
-                if hits == 2 and abs(angle) < angle_threshold and abs(slope) < slope_threshold:
-                    if tags["ratio"] == 100:
-                        log.debug(f"Name matched and ref matched")
+                if entry["geometry"]["type"] == "Point" and len(entry["properties"]) <= 2:
+                    continue
+                if record.geomtype == shapely.GeometryType.POINT and record.tagcount <= 2:
+                    continue
+                # The whole feature is only needed once it might match
+                existing = secondary[index]
+                # log.debug(f"ENTRY: {entry["properties"]}")
+                # log.debug(f"EXISTING: {existing["properties"]}")
+
+                dist = float()
+                slope = float()
+                hits = 0
+
+                if dists is not None:
+                    dist = float(dists[position])
+                else:
+                    try:
+                        with stage("distance"):
+                            dist = cutils.getDistance(entry, existing, newobj, oldgeoms[index])
+                    except:
+                        log.error(f"getDistance() just had a weird error")
                         log.error(f"ENTRY: {entry["properties"]}")
-                        log.error(f"EXISTING: {existing["properties"]["id"]}")
+                        log.error(f"EXISTING: {existing["properties"]}")
+                        # breakpoint()
+                        continue
+
+                # log.debug(f"ENTRY: {dist}: {entry["properties"]}")
+                # log.debug(f"EXISTING: {existing["properties"]}")
+                if dist <= threshold:
+                    if "id" not in existing["properties"]:
+                        existing["properties"]["id"] = -1
+                    angle = 0.0
+                    try:
+                        if dists is not None:
+                            slope = float(slopes[position])
+                            angle = float(angles[position])
+                            if math.isnan(slope):
+                                raise ZeroDivisionError
+                        else:
+                            with stage("slope"):
+                                slope, angle = cutils.getSlope(entry, existing, newobj, oldgeoms[index])
+                    except:
+                        log.error(f"getSlope() just had a weird error")
+                        log.error(f"ENTRY: {entry["properties"]}")
+                        log.error(f"EXISTING: {existing["properties"]}")
+                        # breakpoint()
+                        # slope, angle = cutils.getSlope(entry, existing)
                         break
-                if hits == 0 and angle == 0.0 and slope == 0.0 and dist == 0.0:
-                    print(f"Geometry matched, not name")
-                    log.error(f"ENTRY: {entry["properties"]}")
-                    log.error(f"EXISTING: {existing["properties"]["id"]}")
-                    hits += 1
-                    break
-
-                if hits == 3:
-                    if entry['properties'] != existing['properties']:
-                        # Only add the feature to the output if there are
-                        # differences in the tags. If they are identical,
-                        # ignore it as no changes need to be made.
-                        data.append(Feature(geometry=geom, properties=entry["properties"]))
+                    # log.debug(f"DIST: {dist}, ANGLE: {angle}, SLOPE: {slope}")
+                    # log.debug(f"PRIMARY: {entry["properties"]}")
+                    # log.debug(f"SECONDARY: {existing["properties"]}")
+                    with stage("tags"):
+                        if ratios is not None:
+                            hits, tags = cutils.checkTags(entry, existing, ratios[position])
+                        else:
+                            hits, tags = cutils.checkTags(entry, existing)
+                    # log.debug(f"HITS2: {hits}")
+                    angle_threshold = 20.0
+                    slope_threshold = 4.0
+                    name1 = None
+                    name2 = None
+                    if "name" in existing["properties"]:
+                        name2 = existing["properties"]["name"]
+                    if "name" in entry["properties"]:
+                        name1 = entry["properties"]["name"]
+                    # log.debug(f"DIST: {dist}, SLOPE: {slope:.3f}, Angle: {angle:.3f} - {name1} == {name2}")
+                    if hits == 0 and (abs(angle) > angle_threshold or abs(slope) > slope_threshold):
+                        continue
+                    if hits == 1 and abs(angle) < 15 and abs(slope) < 1:
+                        log.debug(f"Name matched, not geom")
                         log.error(f"ENTRY: {entry["properties"]}")
                         log.error(f"EXISTING: {existing["properties"]["id"]}")
+                        # FIXME parallel roads
                         break
-                    else:
-                        log.debug(f"Perfect match! {entry['properties']}")
+                    if hits == 2 and abs(angle) < angle_threshold and abs(slope) < slope_threshold:
+                        if tags["ratio"] == 100:
+                            log.debug(f"Name matched and ref matched")
+                            log.error(f"ENTRY: {entry["properties"]}")
+                            log.error(f"EXISTING: {existing["properties"]["id"]}")
+                            break
+                    if hits == 0 and angle == 0.0 and slope == 0.0 and dist == 0.0:
+                        print(f"Geometry matched, not name")
+                        log.error(f"ENTRY: {entry["properties"]}")
+                        log.error(f"EXISTING: {existing["properties"]["id"]}")
+                        hits += 1
                         break
 
-                maybe.append({"hits": hits, "dist": dist, "angle": angle, "slope": slope, "odk": entry, "osm": existing})
-                tags["hits"] = str(hits)
-                tags["dist"] = str(dist)
-                tags["slope"] = str(slope)
-                tags["angle"] = str(angle)
-                data.append(Feature(geometry=geom, properties=tags))
-                # cache all OSM features within our threshold distance
-                # These are needed by ODK, but duplicates of other fields,
-                # so they aren't needed and just add more clutter.
-                # log.debug(f"DIST: {dist / 1000}km. {dist}m")
-                # maybe.append({"hits": hits, "dist": dist, "slope": slope, "angle": angle, "hits": hits, "odk": entry, "osm": existing})
-                # don't keep checking every highway, although testing seems
-                # to show 99% only have one distance match within range.
-                if len(maybe) >= 5:
-                    # FIXME: it turns out sometimes the other nearby highways are
-                    # segments of the same highway, but the tags only get added
-                    # to the closest segment.
-                    log.debug(f"Have enough matches.")
-                    break
+                    if hits == 3:
+                        if entry['properties'] != existing['properties']:
+                            # Only add the feature to the output if there are
+                            # differences in the tags. If they are identical,
+                            # ignore it as no changes need to be made.
+                            data.append(Feature(geometry=geom, properties=entry["properties"]))
+                            log.error(f"ENTRY: {entry["properties"]}")
+                            log.error(f"EXISTING: {existing["properties"]["id"]}")
+                            break
+                        else:
+                            log.debug(f"Perfect match! {entry['properties']}")
+                            break
+
+                    maybe.append({"hits": hits, "dist": dist, "angle": angle, "slope": slope, "odk": entry, "osm": existing})
+                    tags["hits"] = str(hits)
+                    tags["dist"] = str(dist)
+                    tags["slope"] = str(slope)
+                    tags["angle"] = str(angle)
+                    data.append(Feature(geometry=geom, properties=tags))
+                    # cache all OSM features within our threshold distance
+                    # These are needed by ODK, but duplicates of other fields,
+                    # so they aren't needed and just add more clutter.
+                    # log.debug(f"DIST: {dist / 1000}km. {dist}m")
+                    # maybe.append({"hits": hits, "dist": dist, "slope": slope, "angle": angle, "hits": hits, "odk": entry, "osm": existing})
+                    # don't keep checking every highway, although testing seems
+                    # to show 99% only have one distance match within range.
+                    if len(maybe) >= 5:
+                        # FIXME: it turns out sometimes the other nearby highways are
+                        # segments of the same highway, but the tags only get added
+                        # to the closest segment.
+                        log.debug(f"Have enough matches.")
+                        break
+            else:
+                # If none of the features with the same reference number
+                # matched well enough, check everything nearby like brute
+                # force does, so a good match isn't reported as new. A
+                # feature that did match ends the search above.
+                if refs is not None and len(maybe) == 0:
+                    del data[start:]
+                    refs = None
+                    continue
+            break
 
         hits = 0
-        threshold = 2
+        hits_threshold = 2
         if len(maybe) > 0:
             # FIXME: Sometimes all the maybes are segment of the same
             # highways. Right now only one gets the tags merged, this
@@ -285,7 +1266,7 @@ def conflateThread(primary: list,
             best = None
             maybe.sort(key=hitsSort)
             hits = maybe[len(maybe) - 1]["hits"]
-            if hits >= threshold:
+            if hits >= hits_threshold:
                 best = maybe[len(maybe) - 1]
                 odk = best["odk"]["properties"]
                 osm = best["osm"]["properties"]
@@ -326,9 +1307,235 @@ def conflateThread(primary: list,
 
         # timer.stop()
 
+    if spans is not None:
+        spans.append((len(data), len(newdata)))
     log.debug(f"NEW: {len(newdata)}")
     return [data, newdata]
 
+def osmVersion(version) -> str:
+    """
+    Get the version of a node or way the same way for every file
+    format. Each one uses its own version, and if it doesn't have one
+    it hasn't been uploaded to OSM yet, so it's version 1.
+
+    Args:
+        version (str|int): The version from the file, which is None or 0 if there isn't one
+
+    Returns:
+        (str): The version, as it is in OSM XML
+    """
+    if version is None or int(version) <= 0:
+        return "1"
+    return str(version)
+
+def nodeProperties(element,
+                   tagfilter: TagFilter = None,
+                   ) -> dict:
+    """
+    Get the properties of a node from OSM XML.
+
+    Args:
+        element (Element): The node element
+        tagfilter (TagFilter): The filter for the nodes to keep
+
+    Returns:
+        (dict): The properties of the node, or None if it's filtered out
+    """
+    if tagfilter is not None:
+        if not tagfilter.nodes:
+            return None
+        if not tagfilter.matches({tag.get("k"): tag.get("v") for tag in element.iter("tag")}):
+            return None
+    properties = {
+        "id": int(element.get("id")),
+    }
+    properties["version"] = osmVersion(element.get("version"))
+
+    if element.get("timestamp") is not None:
+        properties["timestamp"] = element.get("timestamp")
+
+    for tag in element.iter("tag"):
+        # Drop all the TIGER tags based on
+        # https://wiki.openstreetmap.org/wiki/TIGER_fixup
+        if tag.get("k") in properties:
+            if properties[tag.get("k")][:7] == "tiger:":
+                continue
+        properties[tag.get("k")] = tag.get("v").strip()
+    return properties
+
+def wayProperties(element,
+                  tagfilter: TagFilter = None,
+                  ) -> dict:
+    """
+    Get the properties of a way from OSM XML.
+
+    Args:
+        element (Element): The way element
+        tagfilter (TagFilter): The filter for the ways to keep
+
+    Returns:
+        (dict): The properties of the way, or None if it's filtered out
+    """
+    if tagfilter is not None:
+        if not tagfilter.ways:
+            return None
+        if not tagfilter.matches({tag.get("k"): tag.get("v") for tag in element.iter("tag")}):
+            return None
+    properties = {
+        "id": int(element.get("id")),
+    }
+    refs = [int(ref.get("ref")) for ref in element.iter("nd")]
+    if len(refs) > 0:
+        properties["refs"] = refs
+
+    properties["version"] = osmVersion(element.get("version"))
+
+    for tag in element.iter("tag"):
+        properties[tag.get("k")] = tag.get("v").strip()
+    return properties
+
+def wayGeometry(wayid: int,
+                coords: list,
+                refs: list,
+                osmfile: str,
+                ) -> LineString:
+    """
+    Make the geometry of a way from the coordinates of the nodes that
+    were found, so every file format handles missing nodes the same way.
+
+    Args:
+        wayid (int): The way id
+        coords (list): The coordinates of the nodes that were found
+        refs (list): The node ids in the way
+        osmfile (str): The file the way is from
+
+    Returns:
+        (LineString): The geometry, or None if less than 2 nodes were found
+    """
+    if len(coords) < len(refs):
+        log.warning(f"Way {wayid} has nodes not in {osmfile}")
+    if len(coords) < 2:
+        log.debug(f"Way {wayid} doesn't have enough nodes for a LineString, ignoring it")
+        return None
+    return LineString(coords)
+
+def findRanges(osmfile: str,
+               count: int,
+               ) -> list:
+    """
+    Split a OSM XML file into byte ranges that each start with a
+    node, way, or relation element, so they can be parsed separately.
+
+    Args:
+        osmfile (str): The OSM XML file
+        count (int): How many ranges to split the file into
+
+    Returns:
+        (list): The start and end offset of each range
+    """
+    # Attribute values can't contain a <, so this only matches elements
+    pattern = re.compile(rb"<(?:node|way|relation)[\s/>]")
+    size = os.path.getsize(osmfile)
+    window = 1024 * 1024
+
+    def nextElement(file, offset: int) -> int:
+        while offset < size:
+            file.seek(offset)
+            block = file.read(window)
+            match = pattern.search(block)
+            if match:
+                return offset + match.start()
+            # Overlap the blocks so an element can't be split between them
+            offset += max(len(block) - 16, 1)
+        return size
+
+    with open(osmfile, "rb") as file:
+        if b"<osm" not in file.read(window):
+            return list()
+        start = nextElement(file, 0)
+        file.seek(max(size - window, 0))
+        tail = file.read()
+        end = tail.rfind(b"</osm>")
+        if end < 0 or start >= size:
+            return list()
+        end += max(size - window, 0)
+        offsets = [start]
+        for number in range(1, count):
+            offset = nextElement(file, start + (end - start) * number // count)
+            offsets.append(min(max(offset, offsets[-1]), end))
+    offsets.append(end)
+    return [(first, last) for first, last in zip(offsets[:-1], offsets[1:]) if last > first]
+
+def parseRange(osmfile: str,
+               start: int,
+               end: int,
+               tagfilter: TagFilter = None,
+               ) -> dict:
+    """
+    Parse a byte range of a OSM XML file from findRanges(). This is run
+    in a separate process for each range. The ways are returned without
+    geometries, as their nodes may be in a different range.
+
+    Args:
+        osmfile (str): The OSM XML file
+        start (int): The offset of the first element
+        end (int): The offset after the last element
+        tagfilter (TagFilter): The filter for the features to keep
+
+    Returns:
+        (dict): The tagged nodes and ways in file order, and the node
+            ids and coordinates
+    """
+    features = list()
+    ids = pyarray.array("q")
+    coords = pyarray.array("d")
+    parser = XMLPullParser(events=("start", "end"))
+    parser.feed(b"<osm>")
+    root = None
+    depth = 0
+    with open(osmfile, "rb") as file:
+        file.seek(start)
+        remaining = end - start
+        while remaining >= 0:
+            if remaining > 0:
+                block = file.read(min(remaining, 1024 * 1024))
+                remaining -= len(block)
+                parser.feed(block)
+            else:
+                parser.feed(b"</osm>")
+                remaining = -1
+            for event, element in parser.read_events():
+                if event == "start":
+                    if root is None:
+                        root = element
+                    else:
+                        depth += 1
+                    continue
+                depth -= 1
+                # Discard every child of the osm element once it ends,
+                # including the relations, which aren't used.
+                if depth > 0:
+                    continue
+                if element.tag == "node":
+                    lon = float(element.get("lon"))
+                    lat = float(element.get("lat"))
+                    ids.append(int(element.get("id")))
+                    coords.extend((lon, lat))
+                    properties = nodeProperties(element, tagfilter)
+                    if properties is not None and len(properties) > 2:
+                        features.append(Feature(geometry=Point((lon, lat)), properties=properties))
+                elif element.tag == "way":
+                    properties = wayProperties(element, tagfilter)
+                    if properties is not None:
+                        features.append(properties)
+                root.clear()
+    parser.close()
+
+    return {"features": features,
+            "ids": numpy.frombuffer(ids, dtype=numpy.int64),
+            "coords": numpy.frombuffer(coords, dtype=numpy.float64).reshape(-1, 2),
+            }
+
 class Conflator(object):
     def __init__(self,
                  uri: str = None,
@@ -361,6 +1568,8 @@ class Conflator(object):
     def getSlope(self,
             newdata: Feature,
             olddata: Feature,
+            newobj: shapely.Geometry = None,
+            oldobj: shapely.Geometry = None,
             ) -> float:
 
         # timer = Timer(text="getSlope() took {seconds:.0f}s")
@@ -369,12 +1578,11 @@ class Conflator(object):
         # oldline = shape(olddata["geometry"])
         angle = 0.0
         # newline = shape(newdata["geometry"])
-        project = pyproj.Transformer.from_proj(
-            pyproj.Proj(init='epsg:4326'),
-            pyproj.Proj(init='epsg:3857')
-            )
-        newobj = transform(project.transform, shape(newdata["geometry"]))
-        oldobj = transform(project.transform, shape(olddata["geometry"]))
+        # Use the geometries already in meters if we have them.
+        if newobj is None:
+            newobj = shapely.transform(shape(newdata["geometry"]), projectCoords)
+        if oldobj is None:
+            oldobj = shapely.transform(shape(olddata["geometry"]), projectCoords)
         # if newline.type == "MultiLineString":
         #     lines = newline.geoms
         # elif newline.type == "GeometryCollection":
@@ -452,10 +1660,65 @@ class Conflator(object):
                 breakoint()
 
         return slope, bestangle # angle
+
+    def getSlopes(self,
+            newpoints: numpy.ndarray,
+            oldpoints: numpy.ndarray,
+            ) -> tuple:
+        """
+        Compute the slope and angle between a feature and all of the
+        candidate features in one pass. This does the same calculations
+        as getSlope(), using the points from getEndpoints().
+
+        Args:
+            newpoints (numpy.ndarray): The endpoints of the external feature
+            oldpoints (numpy.ndarray): The endpoints of the existing OSM features
+
+        Returns:
+            (numpy.ndarray): The difference in slope for each candidate
+            (numpy.ndarray): The angle to each candidate. Where getSlope()
+                would fail, both the slope and angle are NaN
+        """
+        count = len(oldpoints)
+        points, x1, y1, x2, y2 = newpoints
+        if points == 0:
+            return numpy.full(count, -0.1), numpy.full(count, -0.1)
+        # The new line is too short, or the geometries are identical
+        if math.isnan(x1) or (x1 == x2 and y1 == y2):
+            return numpy.zeros(count), numpy.zeros(count)
+        # getSlope() divides by zero for a vertical line
+        if (x2 - x1) == 0.0:
+            return numpy.full(count, numpy.nan), numpy.full(count, numpy.nan)
+        slope1 = (y2 - y1) / (x2 - x1)
+
+        # Get slope of the old lines
+        dx = oldpoints[:, 3] - oldpoints[:, 1]
+        dy = oldpoints[:, 4] - oldpoints[:, 2]
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            slope2 = dy / dx
+            slope = slope1 - slope2
+            denominator = 1 + (slope2 * slope1)
+            # Calculate the angle between the linestrings
+            angle = numpy.degrees(numpy.arctan((slope2 - slope1) / denominator))
+        slope[numpy.isnan(slope)] = 0.0
+        angle[numpy.isnan(angle)] = 0.0
+
+        # Lines too short, identical, or vertical are all 0.0, and
+        # perpendicular lines make getSlope() divide by zero.
+        degenerate = numpy.isnan(oldpoints[:, 1]) | ((dx == 0.0) & (dy == 0.0)) | (dx == 0.0)
+        failed = ~degenerate & (denominator == 0.0)
+        slope[degenerate] = 0.0
+        angle[degenerate] = 0.0
+        slope[failed] = numpy.nan
+        angle[failed] = numpy.nan
+
+        return slope, angle
       
     def getDistance(self,
             newdata: Feature,
             olddata: Feature,
+            newobj: shapely.Geometry = None,
+            oldobj: shapely.Geometry = None,
             ) -> float:
         """
         Compute the distance between two features in meters
@@ -463,6 +1726,8 @@ class Conflator(object):
         Args:
             newdata (Feature): A feature from the external dataset
             olddata (Feature): A feature from the existing OSM dataset
+            newobj (shapely.Geometry): The external feature already in meters
+            oldobj (shapely.Geometry): The existing feature already in meters
 
         Returns:
             (float): The distance between the two features
@@ -473,13 +1738,11 @@ class Conflator(object):
         dist = float()
 
         # Transform so the results are in meters instead of degress of the
-        # earth's radius.
-        project = pyproj.Transformer.from_proj(
-            pyproj.Proj(init='epsg:4326'),
-            pyproj.Proj(init='epsg:3857')
-            )
-        newobj = transform(project.transform, shape(newdata["geometry"]))
-        oldobj = transform(project.transform, shape(olddata["geometry"]))
+        # earth's radius, unless that's already been done.
+        if newobj is None:
+            newobj = shapely.transform(shape(newdata["geometry"]), projectCoords)
+        if oldobj is None:
+            oldobj = shapely.transform(shape(olddata["geometry"]), projectCoords)
 
         # FIXME: we shouldn't ever get here...
         if oldobj.type == "MultiLineString":
@@ -530,9 +1793,88 @@ class Conflator(object):
         # timer.stop()
         return best # dist # best
 
+    def getDistances(self,
+            newobj: shapely.Geometry,
+            oldobjs: numpy.ndarray,
+            ) -> numpy.ndarray:
+        """
+        Compute the distance between a feature and all of the candidate
+        features in meters. This does the same calculations as
+        getDistance(), but for all the candidates at once, so the loop
+        over the candidates is done by GEOS instead of python.
+
+        Args:
+            newobj (shapely.Geometry): A feature from the external dataset in meters
+            oldobjs (numpy.ndarray): The features from the existing OSM dataset in meters
+
+        Returns:
+            (numpy.ndarray): The distance to each of the candidate features
+        """
+        dists = numpy.full(len(oldobjs), numpy.nan)
+        if newobj.geom_type in ("MultiLineString", "GeometryCollection"):
+            lines = shapely.get_parts(newobj)
+        elif newobj.geom_type == "LineString":
+            lines = [newobj]
+        else:
+            # getDistance() fails on anything else, so nothing matches
+            return dists
+
+        oldtypes = shapely.get_type_id(oldobjs)
+        linestring = oldtypes == shapely.GeometryType.LINESTRING
+        point = oldtypes == shapely.GeometryType.POINT
+        polygon = oldtypes == shapely.GeometryType.POLYGON
+
+        # Like getDistance(), a geometry combination that isn't supported
+        # keeps the distance of the previous segment.
+        dist = numpy.zeros(len(oldobjs))
+        best = None
+        for segment in lines:
+            shapely.prepare(segment)
+            if segment.geom_type == "LineString":
+                mask = linestring
+                dist = numpy.where(point, 12345678.9, dist)
+            elif segment.geom_type == "Point":
+                mask = linestring | point
+                if polygon.any():
+                    # Compare a point with a building, used for ODK Collect data
+                    dist[polygon] = shapely.distance(segment, shapely.centroid(oldobjs[polygon]))
+            else:
+                mask = numpy.zeros(len(oldobjs), dtype=bool)
+            if mask.any():
+                dist[mask] = shapely.distance(segment, oldobjs[mask])
+
+            # Find the closest segment
+            if best is None:
+                best = dist.copy()
+            else:
+                best = numpy.where(dist < best, dist, best)
+
+        if best is None:
+            return dists
+        return best
+
+    def getRatios(self,
+                  extfeat: Feature,
+                  records: list,
+                  ) -> list:
+        """
+        Get the fuzzy match ratios of the tags checkTags() compares
+        between one feature and many others. conflateThread() uses a
+        RatioMatrix for the whole batch instead.
+
+        Args:
+            extfeat (Feature): The feature from the external dataset
+            records (list): The FeatureRecords to compare it with
+
+        Returns:
+            (list): The ratio for each tag, for each of the features
+        """
+        return RatioMatrix([extfeat], records).ratios(extfeat, records)
+
     def checkTags(self,
                   extfeat: Feature,
                   osm: Feature,
+                  ratios: dict = None,
                    ):
         """
         Check tags between 2 features.
@@ -540,13 +1882,14 @@ class Conflator(object):
         Args:
             extfeat (Feature): The feature from the external dataset
             osm (Feature): The result of the SQL query
+            ratios (dict): The fuzzy match ratios from getRatios(), if already done
 
         Returns:
             (int): The number of tag matches
             (dict): The updated tags
         """
-        match_threshold = 85
-        match = ["name", "ref", "ref:usfs"]
+        match_threshold = MATCH_THRESHOLD
+        match = MATCH_TAGS
         hits = 0
         props = dict()
         id = 0
@@ -594,7 +1937,10 @@ class Conflator(object):
                 # ratio in the low 80s. In that case they should be
                 # a similar length.
                 length = len(extfeat["properties"][key]) - len(osm["properties"][key])
-                ratio = fuzz.ratio(extfeat["properties"][key].lower(), osm["properties"][key].lower())
+                if ratios is not None and key in ratios:
+                    ratio = ratios[key]
+                else:
+                    ratio = fuzzyRatio(extfeat["properties"][key], osm["properties"][key])
                 if ratio > match_threshold and length <= 3:
                     hits += 1
                     props["ratio"] = ratio
@@ -606,10 +1952,8 @@ class Conflator(object):
                             # This assume all the data has been converted
                             # by one of the utility programs, which enfore
                             # using the ref:usfs tag.
-                            tmp = extfeat["properties"]["ref:usfs"].split(' ')
-                            extref = tmp[1].upper()
-                            tmp = osm["properties"]["ref:usfs"].split(' ')
-                            newref = tmp[1].upper()
+                            extref = normalizeRef(extfeat["properties"]["ref:usfs"])
+                            newref = normalizeRef(osm["properties"]["ref:usfs"])
                             # log.debug(f"REFS: {extref} vs {newref}: {extref == newref}")
                             if extref == newref:
                                 hits += 1
@@ -628,110 +1972,239 @@ class Conflator(object):
         # print(props)
         return hits, props
 
-    def loadFile(
-        self,
-        osmfile: str,
-    ) -> list:
+    def readOSM(self,
+                osmfile: str,
+                cache: str = None,
+                tagfilter: TagFilter = None,
+                ):
         """
-        Read a OSM XML file and convert it to GeoJson for consistency.
+        Read a OSM XML file one element at a time, and convert the
+        tagged nodes and the ways to GeoJson. Each element is discarded
+        once it's converted, and the node coordinates are kept in arrays
+        sorted by node id, so memory use stays small for large files.
 
         Args:
             osmfile (str): The OSM XML file to load
+            cache (str): The directory to keep the node coordinates in, instead of memory
+            tagfilter (TagFilter): The filter for the features to keep
 
         Returns:
-            (list): The entries in the OSM XML file
+            (generator): The features in the OSM XML file
+        """
+        context = iterparse(osmfile, events=("start", "end"))
+        event, root = next(context)
+        if root.tag != "osm":
+            logging.warning("No data in this instance")
+            return
+
+        nodes = NodeCache(cache, osmfile)
+        depth = 0
+        for event, element in context:
+            if event == "start":
+                depth += 1
+                continue
+            depth -= 1
+            # Only the children of the osm element are used. Every one
+            # of them is discarded once it ends, including the relations
+            # and anything else that isn't converted.
+            if depth > 0:
+                continue
+            if element.tag == "node":
+                lon = float(element.get("lon"))
+                lat = float(element.get("lat"))
+                # cache the nodes so we can dereference the refs into
+                # coordinates, but we don't need them in GeoJson format.
+                nodes.add(int(element.get("id")), lon, lat)
+                properties = nodeProperties(element, tagfilter)
+                if properties is not None and len(properties) > 2:
+                    yield Feature(geometry=Point((lon, lat)), properties=properties)
+            elif element.tag == "way":
+                properties = wayProperties(element, tagfilter)
+                if properties is not None:
+                    refs = properties.get("refs", [])
+                    coords, found = nodes.locations(refs)
+                    geom = wayGeometry(properties["id"], coords.tolist(), refs, osmfile)
+                    # log.debug(f"WAY: {properties}")
+                    if geom is not None:
+                        yield Feature(geometry=geom, properties=properties)
+            root.clear()
+
+        if len(nodes) == 0:
+            logging.warning("No nodes in this instance")
+
+    def loadPBF(self,
+                osmfile: str,
+                tagfilter: TagFilter = None,
+                cache: str = None,
+                ) -> list:
+        """
+        Read a OSM PBF file and convert it to GeoJson, the same as
+        loadFile() does for OSM XML files. The node locations are
+        added to the ways while reading, so the file is only read once.
+
+        Args:
+            osmfile (str): The OSM PBF file to load
+            tagfilter (TagFilter): The filter for the features to keep
+            cache (str): The directory to keep the node coordinates in, instead of memory
+
+        Returns:
+            (list): The entries in the OSM PBF file
         """
         alldata = list()
-        size = os.path.getsize(osmfile)
-        with open(osmfile, "r") as file:
-            xml = file.read(size)
-            doc = xmltodict.parse(xml)
-            if "osm" not in doc:
-                logging.warning("No data in this instance")
-                return False
-            data = doc["osm"]
-            if "node" not in data:
-                logging.warning("No nodes in this instance")
-                return False
-
-        nodes = dict()
-        for node in data["node"]:
+        processor = osmium.FileProcessor(str(osmfile), osmium.osm.NODE | osmium.osm.WAY)
+        nodes = None
+        if cache is not None:
+            nodes = NodeCache(cache, osmfile)
+        else:
+            processor = processor.with_locations()
+        # The node locations are still cached for the ways when
+        # the nodes themselves are filtered out, but every node has
+        # to be seen to fill our own cache.
+        everynode = nodes is not None and not nodes.valid
+        if tagfilter is not None:
+            if len(tagfilter.keys()) > 0:
+                keyfilter = osmium.filter.KeyFilter(*tagfilter.keys())
+                if everynode:
+                    keyfilter = keyfilter.enable_for(osmium.osm.WAY)
+                processor = processor.with_filter(keyfilter)
+            if not tagfilter.nodes and not everynode:
+                processor = processor.with_filter(osmium.filter.EntityFilter(osmium.osm.WAY))
+        for obj in processor:
+            if tagfilter is not None:
+                if obj.is_node():
+                    keep = tagfilter.nodes
+                else:
+                    keep = tagfilter.ways
+                keep = keep and tagfilter.matches(dict(obj.tags))
+            else:
+                keep = True
             properties = {
-                "id": int(node["@id"]),
+                "id": obj.id,
             }
-            if "@version" not in node:
-                properties["version"] = 1
-            else:
-                properties["version"] = node["@version"]
-
-            if "@timestamp" in node:
-                properties["timestamp"] = node["@timestamp"]
-
-            if "tag" in node:
-                for tag in node["tag"]:
-                    if type(tag) == dict:
-                        # Drop all the TIGER tags based on
-                        # https://wiki.openstreetmap.org/wiki/TIGER_fixup
-                        if tag["@k"] in properties:
-                            if properties[tag["@k"]][:7] == "tiger:":
-                                continue
-                        properties[tag["@k"]] = tag["@v"].strip()
-                        # continue
-                    else:
-                        properties[node["tag"]["@k"]] = node["tag"]["@v"].strip()
-                    # continue
-            geom = Point((float(node["@lon"]), float(node["@lat"])))
-            # cache the nodes so we can dereference the refs into
-            # coordinates, but we don't need them in GeoJson format.
-            nodes[properties["id"]] = geom
-            if len(properties) > 2:
+            if obj.is_node():
+                if nodes is not None:
+                    nodes.add(obj.id, obj.location.lon, obj.location.lat)
+                if not keep:
+                    continue
+                properties["version"] = osmVersion(obj.version)
+                if obj.timestamp.timestamp() > 0:
+                    properties["timestamp"] = obj.timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")
+                for tag in obj.tags:
+                    properties[tag.k] = tag.v.strip()
+                if len(properties) > 2:
+                    geom = Point((obj.location.lon, obj.location.lat))
+                    alldata.append(Feature(geometry=geom, properties=properties))
+            elif keep:
+                refs = [node.ref for node in obj.nodes]
+                if nodes is not None:
+                    coords, found = nodes.locations(refs)
+                    coords = coords.tolist()
+                else:
+                    coords = [(node.lon, node.lat) for node in obj.nodes if node.location.valid()]
+                if len(refs) > 0:
+                    properties["refs"] = refs
+                geom = wayGeometry(obj.id, coords, refs, osmfile)
+                if geom is None:
+                    continue
+                properties["version"] = osmVersion(obj.version)
+                for tag in obj.tags:
+                    properties[tag.k] = tag.v.strip()
                 alldata.append(Feature(geometry=geom, properties=properties))
 
-        for way in data["way"]:
-            attrs = dict()
-            properties = {
-                "id": int(way["@id"]),
-            }
-            refs = list()
-            if "nd" in way:
-                if len(way["nd"]) > 0:
-                    for ref in way["nd"]:
-                        refs.append(int(ref["@ref"]))
-                properties["refs"] = refs
-
-            if "@version" not in node:
-                properties["version"] = 1
-            else:
-                properties["version"] = node["@version"]
+        return alldata
+
+    def readParallel(self,
+                     osmfile: str,
+                     processes: int,
+                     cache: str = None,
+                     tagfilter: TagFilter = None,
+                     ) -> list:
+        """
+        Read a OSM XML file using multiple processes, each parsing part
+        of the file. The nodes from all the parts are then used to add
+        the geometries to the ways.
 
-            if "@timestamp" in node:
-                attrs["timestamp"] = node["@timestamp"]
+        Args:
+            osmfile (str): The OSM XML file to load
+            processes (int): The number of processes to use
+            cache (str): The directory to keep the node coordinates in, instead of memory
+            tagfilter (TagFilter): The filter for the features to keep
 
-            if "tag" in way:
-                for tag in way["tag"]:
-                    if type(tag) == dict:
-                        properties[tag["@k"]] = tag["@v"].strip()
-                        # continue
-                    else:
-                        properties[way["tag"]["@k"]] = way["tag"]["@v"].strip()
-                    # continue
-            # geom =
-            tmp = list()
-            for ref in refs:
-                tmp.append(nodes[ref]['coordinates'])
-            geom = LineString(tmp)
-            if geom is None:
-                breakpoint()
-            # log.debug(f"WAY: {properties}")
-            alldata.append(Feature(geometry=geom, properties=properties))
+        Returns:
+            (list): The entries in the OSM XML file
+        """
+        ranges = findRanges(osmfile, processes)
+        if len(ranges) == 0:
+            return list(self.readOSM(osmfile, cache, tagfilter))
+        log.debug(f"Parsing {osmfile} in {len(ranges)} parts")
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(parseRange, str(osmfile), start, end, tagfilter) for start, end in ranges]
+            results = [future.result() for future in futures]
+
+        nodes = NodeCache(cache, osmfile)
+        for result in results:
+            nodes.extend(result["ids"], result["coords"])
+            del result["ids"], result["coords"]
+        if len(nodes) == 0:
+            logging.warning("No nodes in this instance")
+
+        alldata = list()
+        for result in results:
+            for entry in result["features"]:
+                if isinstance(entry, Feature):
+                    alldata.append(entry)
+                    continue
+                refs = entry.get("refs", [])
+                coords, found = nodes.locations(refs)
+                geom = wayGeometry(entry["id"], coords.tolist(), refs, osmfile)
+                if geom is not None:
+                    alldata.append(Feature(geometry=geom, properties=entry))
+            result["features"] = None
 
         return alldata
 
+    def loadFile(
+        self,
+        osmfile: str,
+        cache: str = None,
+        processes: int = None,
+        tagfilter: TagFilter = None,
+    ) -> list:
+        """
+        Read a OSM XML file and convert it to GeoJson for consistency.
+        Large files are read in parallel.
+
+        Args:
+            osmfile (str): The OSM XML file to load
+            cache (str): The directory to keep the node coordinates in, instead of memory
+            processes (int): The number of processes to use, the default depends on the file size
+            tagfilter (TagFilter): The filter for the features to keep
+
+        Returns:
+            (list): The entries in the OSM XML file
+        """
+        if processes is None:
+            processes = cores if os.path.getsize(osmfile) >= PARALLEL_SIZE else 1
+        if processes > 1:
+            return self.readParallel(osmfile, processes, cache, tagfilter)
+        return list(self.readOSM(osmfile, cache, tagfilter))
+
     def conflateData(self,
                     primaryspec: str,
                     secondaryspec: str,
                     threshold: float = 3.0,
                     informal: bool = False,
+                    bruteforce: bool = False,
+                    partition: bool = False,
+                    sharemem: bool = False,
+                    writer: ResultWriter = None,
+                    checkpoint: str = None,
+                    runstore: str = None,
+                    timing: str = None,
+                    nodecache: str = None,
+                    tagfilter: TagFilter = None,
+                    datacache: str = None,
                     ) -> list:
         """
         Open the two source files and contlate them.
@@ -741,12 +2214,24 @@ class Conflator(object):
             secondary pec (str): The secondary dataset filespec
             threshold (float): Threshold for distance calculations in meters
             informal (bool): Whether to dump features in OSM not in external data
+            bruteforce (bool): Compare against every feature instead of using a spatial index
+            partition (bool): Split the data into spatial tiles for each process
+            sharemem (bool): Put the secondary dataset in memory shared by all processes
+            writer (ResultWriter): Write the output as it's done instead of returning it
+            checkpoint (str): The directory to save finished batches in, so an interrupted run can be resumed
+            runstore (str): The database of the last run, so only what changed since then is conflated again
+            timing (str): The file to write how long each stage of the conflation took to
+            nodecache (str): The directory to keep the secondary dataset's node coordinates in
+            tagfilter (TagFilter): The filter for the secondary features to load
+            datacache (str): The directory to cache the parsed datasets in
 
         Returns:
-            (list):  The conflated output
+            (list):  The conflated output, which is empty when using a writer
         """
         timer = Timer(text="conflateData() took {seconds:.0f}s")
         timer.start()
+        global timings
+        timings = dict() if timing is not None else None
         odkdata = list()
         osmdata = list()
 
@@ -755,18 +2240,19 @@ class Conflator(object):
         #     db = GeoSupport(odkspec[3:])
         #     result = await db.queryDB()
         # else:
-        primarydata = self.parseFile(primaryspec)
+        with stage("load"):
+            primarydata = self.parseFile(primaryspec, datacache=datacache)
 
         # if osmspec[:3].lower() == "pg:":
         #     db = GeoSupport(osmspec[3:])
         #     result = await db.queryDB()
         # else:
-        secondarydata = self.parseFile(secondaryspec)
+        with stage("load"):
+            secondarydata = self.parseFile(secondaryspec, tagfilter, nodecache, datacache)
 
         entries = len(primarydata)
-        chunk = round(entries / cores)
 
-        alldata = list()
+        alldata = [list(), list()]
         tasks = list()
 
         log.info(f"The primary dataset has {len(primarydata)} entries")
@@ -776,25 +2262,153 @@ class Conflator(object):
         single = False
 
         if single:
-            alldata = conflateThread(primarydata, secondarydata)
+            alldata = conflateThread(primarydata, secondarydata, informal, threshold, bruteforce=bruteforce)
+            if writer is not None:
+                with stage("write"):
+                    writer.write(alldata[0], alldata[1])
+                alldata = [list(), list()]
         else:
-            futures = list()
-            with concurrent.futures.ProcessPoolExecutor(max_workers=cores) as executor:
-                for block in range(0, entries, chunk):
-                    future = executor.submit(conflateThread,
-                            primarydata[block:block + chunk - 1],
-                            secondarydata,
-                            informal
-                            )
-                    futures.append(future)
-                #for thread in concurrent.futures.wait(futures, return_when='ALL_COMPLETED'):
-                for future in concurrent.futures.as_completed(futures):
-                    log.debug(f"Waiting for thread to complete..")
-                    alldata += future.result()
-
-            executor.shutdown()
-
-        timer.stop()
+            if partition and not bruteforce:
+                # Each process only gets the secondary features near
+                # its tile, instead of the entire dataset.
+                tiles = partitionData(primarydata, secondarydata, threshold, cores * 4)
+            else:
+                tiles = [(numpy.arange(entries), None)]
+
+            def output(data: list, new: list):
+                if writer is not None:
+                    with stage("write"):
+                        writer.write(data, new)
+                else:
+                    alldata[0] += data
+                    alldata[1] += new
+
+            # Reuse the output from the last run for the features where
+            # nothing has changed.
+            finished = list()
+            runs = None
+            if runstore is not None:
+                runs = RunStore(runstore, threshold, informal, bruteforce)
+                unchanged = runs.compare(primarydata, shapely.bounds(projectGeometries(primarydata)),
+                                         secondarydata, shapely.bounds(projectGeometries(secondarydata)),
+                                         threshold)
+                for data, new in runs.load(unchanged):
+                    output(data, new)
+                finished += unchanged.tolist()
+
+            # Use the batches already finished by a previous run, and
+            # only do the rest.
+            saved = None
+            if checkpoint is not None:
+                saved = Checkpoint(checkpoint, primaryspec, secondaryspec, threshold, informal, bruteforce, tagfilter)
+                done = set(finished)
+                for indexes, data, new, spans in saved.load():
+                    # The output from the last run already has these,
+                    # and any others in the batch are done again.
+                    if not done.isdisjoint(indexes):
+                        continue
+                    finished += indexes
+                    if runs is not None:
+                        runs.record(indexes, data, new, spans)
+                    output(data, new)
+            if finished:
+                log.info(f"{len(finished)} of {entries} primary features were already done")
+                tiles = [(primary[~numpy.isin(primary, finished)], nearby) for primary, nearby in tiles]
+            batches = Batches(tiles, cores)
+
+            # Each process gets the secondary dataset once when it
+            # starts. Instead of every process getting it's own copy,
+            # they can all use one in shared memory.
+            store = None
+            if isinstance(secondarydata, FeatureStore):
+                secondarystore = secondarydata
+            else:
+                secondarystore = FeatureStore(secondarydata)
+            try:
+                if sharemem:
+                    store = secondarystore
+                    initargs = (store.share(), timing is not None)
+                else:
+                    # The arrays are much smaller to send to each process
+                    # than the features.
+                    initargs = (secondarystore, timing is not None)
+
+                with concurrent.futures.ProcessPoolExecutor(max_workers=cores,
+                                                            initializer=initWorker,
+                                                            initargs=initargs) as executor:
+                    # Only keep a few batches queued for each process, so
+                    # whichever one finishes first gets the next batch.
+                    futures = dict()
+                    while True:
+                        while len(futures) < cores * 2:
+                            batch = batches.next()
+                            if batch is None:
+                                break
+                            number, tile, indexes, nearby = batch
+                            future = executor.submit(conflateBatch,
+                                    number,
+                                    tile,
+                                    [primarydata[index] for index in indexes],
+                                    nearby,
+                                    informal,
+                                    threshold,
+                                    bruteforce,
+                                    )
+                            futures[future] = indexes
+                        if len(futures) == 0:
+                            break
+                        log.debug(f"Waiting for thread to complete..")
+                        done, pending = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            number, stats, result = future.result()
+                            indexes = futures.pop(future)
+                            batches.update(number, len(indexes), stats)
+                            if "timings" in stats:
+                                addTimings(stats["timings"])
+                            if saved is not None:
+                                saved.save(indexes, *result)
+                            # This has to be done before the output is
+                            # written, as that changes the tags.
+                            if runs is not None:
+                                runs.record(indexes, *result)
+                            output(result[0], result[1])
+
+                executor.shutdown()
+                batches.report()
+            finally:
+                # Otherwise the shared memory is left in /dev/shm if a
+                # worker fails or the run is interrupted.
+                if store is not None:
+                    store.close(True)
+            if runs is not None:
+                runs.commit()
+
+        seconds = timer.stop()
+        if timing is not None:
+            report = {"parameters": {"primary": primaryspec,
+                                     "secondary": secondaryspec,
+                                     "threshold": threshold,
+                                     "informal": informal,
+                                     "bruteforce": bruteforce,
+                                     "partition": partition,
+                                     "sharemem": sharemem,
+                                     "checkpoint": checkpoint,
+                                     "runstore": runstore,
+                                     "nodecache": nodecache,
+                                     "datacache": datacache,
+                                     "tagfilter": tagfilter.config if tagfilter is not None else None,
+                                     "cores": cores,
+                                     },
+                      "inputs": {"primary": len(primarydata),
+                                 "secondary": len(secondarydata),
+                                 },
+                      "seconds": seconds,
+                      "stages": {name: {"calls": count, "seconds": total} for name, (count, total) in timings.items()},
+                      }
+            with open(timing, "w") as file:
+                json.dump(report, file, indent=4)
+            log.info(f"Wrote {timing}")
+            timings = None
 
         return alldata
 
@@ -810,29 +2424,45 @@ class Conflator(object):
 
     def parseFile(self,
                 filespec: str,
+                tagfilter: TagFilter = None,
+                cache: str = None,
+                datacache: str = None,
                 ) ->list:
         """
         Parse the input file based on it's format.
 
         Args:
             filespec (str): The file to parse
+            tagfilter (TagFilter): The filter for the features to keep
+            cache (str): For OSM files, the directory to keep the node coordinates in
+            datacache (str): The directory to cache the parsed data in
 
         Returns:
-            (list): The parsed data from the file
+            (list): The parsed data from the file, or a FeatureStore if it was cached
         """
+        saved = None
+        if datacache is not None:
+            saved = DataCache(datacache, filespec, tagfilter)
+            store = saved.load()
+            if store is not None:
+                return store
+
         path = Path(filespec)
         data = list()
         if path.suffix == '.geojson':
             # FIXME: This should also work for any GeoJson file, not
             # only  ones, but this has yet to be tested.
             log.debug(f"Parsing GeoJson files {path}")
-            file = open(path, 'r')
-            features = geojson.load(file)
-            data = features['features']
+            for feature in streamFeatures(path):
+                if tagfilter is None or tagfilter.wants(feature):
+                    data.append(feature)
         elif path.suffix == '.osm':
             log.debug(f"Parsing OSM XML files {path}")
             # osmfile = OsmFile()
-            data = self.loadFile(path)
+            data = self.loadFile(path, cache, tagfilter=tagfilter)
+        elif path.suffix == '.pbf':
+            log.debug(f"Parsing OSM PBF files {path}")
+            data = self.loadPBF(path, tagfilter, cache)
         elif path.suffix == ".csv":
             log.debug(f"Parsing csv files {path}")
             odk = ODKParsers()
@@ -843,6 +2473,8 @@ class Conflator(object):
             odk  = ODKParsers()
             for entry in odk.JSONparser(path):
                 data.append(odk.createEntry(entry))
+        if saved is not None:
+            saved.save(data)
         return data
 
     def conflateDB(self,
@@ -928,6 +2560,19 @@ class Conflator(object):
             filespec (str): The output file name
         """
         osm = OsmFile(filespec)
+        self.writeOSMFeatures(osm, data)
+
+    def writeOSMFeatures(self,
+                         osm: OsmFile,
+                         data: list,
+                         ):
+        """
+        Write features to an OSM XML file that is already open.
+
+        Args:
+            osm (OsmFile): The OSM XML file
+            data (list): The list of GeoJson features
+        """
         negid = -100
         id = -1
         out = str()
@@ -1067,12 +2712,20 @@ osm-rawdata project on pypi.org or https://github.com/hotosm/osm-rawdata.
     parser.add_argument("-v", "--verbose", action="store_true", help="verbose output")
     parser.add_argument("-s", "--secondary", help="The secondary dataset")
     parser.add_argument("-q", "--query", help="Custom SQL when using a database")
-    parser.add_argument("-c", "--config", default="highway", help="The config file for the SQL query")
+    parser.add_argument("-c", "--config", help="The config file for the SQL query, also used to only load the matching secondary features")
     parser.add_argument("-p", "--primary", required=True, help="The primary dataset")
     parser.add_argument("-t", "--threshold", default=2.0, help="Threshold for distance calculations")
     parser.add_argument("-i", "--informal", help="Dump features not in official sources")
     parser.add_argument("-o", "--outfile", default="conflated.geojson", help="Output file from the conflation")
     parser.add_argument("-b", "--boundary", help="Optional boundary polygon to limit the data size")
+    parser.add_argument("-f", "--bruteforce", action="store_true", help="Compare every feature instead of using a spatial index")
+    parser.add_argument("-g", "--partition", action="store_true", help="Split the data into spatial tiles for each process")
+    parser.add_argument("-m", "--sharemem", action="store_true", help="Put the secondary dataset in shared memory")
+    parser.add_argument("-k", "--checkpoint", help="Directory to save finished work in, to resume an interrupted run")
+    parser.add_argument("-r", "--runstore", help="Database of the last run, to only conflate what changed since then")
+    parser.add_argument("-j", "--timing", help="Write how long each stage of the conflation took to this JSON file")
+    parser.add_argument("-n", "--nodecache", help="Directory to cache the OSM node locations in, instead of memory")
+    parser.add_argument("-d", "--datacache", help="Directory to cache the parsed datasets in, so unchanged files aren't parsed again")
 
     args = parser.parse_args()
     indata = None
@@ -1112,20 +2765,14 @@ osm-rawdata project on pypi.org or https://github.com/hotosm/osm-rawdata.
     # if args.primary[:3].lower() == "pg:":
     #     await conflate.initInputDB(args.config, args.secondary[3:])
 
-    data = conflate.conflateData(args.primary, args.secondary, float(args.threshold), args.informal)
-
-    # path = Path(args.outfile)
-    osmout  = args.outfile.replace(".geojson", "-out.osm")
-
-    conflate.writeOSM(data[0], osmout)
-    log.info(f"Wrote {osmout}")
-
-    jsonout = args.outfile.replace(".geojson", "-out.geojson")
-    conflate.writeGeoJson(data[0], jsonout)
-    log.info(f"Wrote {jsonout}")
-
-    jsonout = args.outfile.replace(".geojson", "-new.geojson")
-    conflate.writeGeoJson(data[1], jsonout)
+    # The output files are written as the conflation is done, so the
+    # results don't all have to fit in memory.
+    tagfilter = None
+    if args.config:
+        tagfilter = TagFilter(args.config)
+    writer = ResultWriter(conflate, args.outfile)
+    conflate.conflateData(args.primary, args.secondary, float(args.threshold), args.informal, args.bruteforce, args.partition, args.sharemem, writer, args.checkpoint, args.runstore, args.timing, args.nodecache, tagfilter, args.datacache)
+    writer.close()
 
 if __name__ == "__main__":
     """This is just a hook so this file can be run standlone during development."""
@@ -0,0 +1,545 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2024 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+#
+# This stores a dataset in a few flat arrays instead of a list of
+# GeoJson features, so it can be put in shared memory and used by all
+# the processes without each one getting it's own copy.
+#
+
+import logging
+import copy
+import json
+import os
+from multiprocessing import shared_memory
+from geojson import Feature
+from shapely.geometry import shape
+import shapely
+import numpy
+
+# Instantiate logger
+log = logging.getLogger(__name__)
+
+class FeatureRecord(object):
+    # Slots use much less memory than a dict for each feature
+    __slots__ = ("index", "id", "version", "geomtype", "tagcount", "tags", "refs")
+
+    def __init__(self,
+                 index: int,
+                 id: int,
+                 version: int,
+                 geomtype: int,
+                 tagcount: int,
+                 tags: dict,
+                 refs: numpy.ndarray = None,
+                 ):
+        """
+        This class has only what the conflation needs to decide if two
+        features match. The geometry stays in the coordinate arrays, and
+        the whole feature is only built when it's added to the output.
+
+        Args:
+            index (int): The index of the feature in the dataset
+            id (int): The OSM ID, or None
+            version (int): The OSM version, or None
+            geomtype (int): The shapely geometry type ID, or -1 for no geometry
+            tagcount (int): The number of tags the feature has
+            tags (dict): The tags used for matching
+            refs (numpy.ndarray): The nodes in a way, or None
+
+        Returns:
+            (FeatureRecord): An instance of this object
+        """
+        self.index = index
+        self.id = id
+        self.version = version
+        self.geomtype = geomtype
+        self.tagcount = tagcount
+        self.tags = tags
+        self.refs = refs
+
+class FeatureStore(object):
+    def __init__(self,
+                 features: list = None,
+                 projected: numpy.ndarray = None,
+                 ):
+        """
+        This class stores a dataset of features as flat arrays. The
+        geometries are kept as WKB with their bounding boxes, and only
+        turned into shapely geometries when they're used. The tags are
+        dictionary encoded, so each unique key and value is only stored
+        once.
+
+        Args:
+            features (list): The GeoJson features to store
+            projected (numpy.ndarray): The geometries in meters, if they should be stored too
+
+        Returns:
+            (FeatureStore): An instance of this object
+        """
+        self.arrays = dict()
+        self.shm = None
+        # The features in this view of the data, or None for all of them
+        self.index = None
+        # These are filled in as the data is used, and shared with
+        # any views of the data.
+        self.strings = dict()
+        self.features = dict()
+        self.cache = dict()
+        if features is not None:
+            self.encode(features, projected)
+
+    def encode(self,
+               features: list,
+               projected: numpy.ndarray = None,
+               ):
+        """
+        Convert a list of features into the arrays.
+
+        Args:
+            features (list): The GeoJson features to store
+            projected (numpy.ndarray): The geometries in meters, if they should be stored too
+        """
+        geoms = numpy.empty(len(features), dtype=object)
+        for index, feature in enumerate(features):
+            if feature["geometry"] is not None:
+                geoms[index] = shape(feature["geometry"])
+
+        # A missing geometry has no WKB
+        wkb = shapely.to_wkb(geoms)
+        self.arrays["wkb"], self.arrays["wkboffsets"] = self.pack([blob if blob is not None else b"" for blob in wkb])
+        self.arrays["bounds"] = shapely.bounds(geoms)
+        self.arrays["types"] = shapely.get_type_id(geoms).astype(numpy.int8)
+        if projected is not None:
+            wkb = shapely.to_wkb(projected)
+            self.arrays["projected"], self.arrays["projectedoffsets"] = self.pack([blob if blob is not None else b"" for blob in wkb])
+
+        # The tags are stored as JSON so numbers keep their type, except
+        # the refs of a way which are stored as integers. A value of -1
+        # means the value is in the refs.
+        strings = dict()
+        keys = list()
+        values = list()
+        tags = [0]
+        refs = list()
+        refoffsets = [0]
+        for feature in features:
+            properties = feature["properties"]
+            if properties is None:
+                properties = dict()
+            for key, value in properties.items():
+                keys.append(strings.setdefault(key, len(strings)))
+                if key == "refs" and type(value) == list:
+                    values.append(-1)
+                    refs.extend(value)
+                else:
+                    values.append(strings.setdefault(json.dumps(value), len(strings)))
+            tags.append(len(keys))
+            refoffsets.append(len(refs))
+        self.arrays["keys"] = numpy.array(keys, dtype=numpy.int32)
+        self.arrays["values"] = numpy.array(values, dtype=numpy.int32)
+        self.arrays["tags"] = numpy.array(tags, dtype=numpy.int64)
+        self.arrays["refs"] = numpy.array(refs, dtype=numpy.int64)
+        self.arrays["refoffsets"] = numpy.array(refoffsets, dtype=numpy.int64)
+        self.arrays["strings"], self.arrays["stringoffsets"] = self.pack([string.encode("utf-8") for string in strings])
+
+    def pack(self,
+             blobs: list,
+             ) -> tuple:
+        """
+        Pack a list of bytes into one array.
+
+        Args:
+            blobs (list): The bytes to pack
+
+        Returns:
+            (numpy.ndarray): All of the bytes
+            (numpy.ndarray): The offset of each entry in the bytes
+        """
+        offsets = numpy.zeros(len(blobs) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(blob) for blob in blobs], out=offsets[1:])
+        return numpy.frombuffer(b"".join(blobs), dtype=numpy.uint8), offsets
+
+    def save(self,
+             directory: str,
+             ):
+        """
+        Write the arrays to files, so they can be used by load() without
+        parsing the dataset again.
+
+        Args:
+            directory (str): The directory to write the files in
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name, array in self.arrays.items():
+            numpy.save(f"{directory}/{name}.npy", array)
+        # This is written last, so the files are only used once
+        # they're all complete.
+        with open(f"{directory}/arrays.json", "w") as file:
+            json.dump(list(self.arrays.keys()), file)
+
+    @classmethod
+    def load(cls,
+             directory: str,
+             ):
+        """
+        Use the arrays written by save(). The files are memory mapped,
+        so only the parts that get used are read.
+
+        Args:
+            directory (str): The directory with the files
+
+        Returns:
+            (FeatureStore): An instance of this object
+        """
+        store = cls()
+        with open(f"{directory}/arrays.json", "r") as file:
+            names = json.load(file)
+        for name in names:
+            store.arrays[name] = numpy.load(f"{directory}/{name}.npy", mmap_mode="r")
+        return store
+
+    def share(self) -> dict:
+        """
+        Copy the arrays into a block of shared memory, so they can be
+        used by other processes with attach().
+
+        Returns:
+            (dict): The name and layout of the shared memory
+        """
+        layout = list()
+        size = 0
+        for name, array in self.arrays.items():
+            layout.append((name, array.dtype.str, array.shape, size))
+            # Keep every array aligned
+            size += (array.nbytes + 7) & ~7
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for name, dtype, dims, offset in layout:
+            array = numpy.ndarray(dims, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            array[...] = self.arrays[name]
+            self.arrays[name] = array
+        log.debug(f"Put {size} bytes in shared memory {self.shm.name}")
+
+        return {"name": self.shm.name, "layout": layout}
+
+    @classmethod
+    def attach(cls,
+               spec: dict,
+               ):
+        """
+        Use the arrays in shared memory created by share(). The arrays
+        use the shared memory directly, nothing is copied.
+
+        Args:
+            spec (dict): The name and layout from share()
+
+        Returns:
+            (FeatureStore): An instance of this object
+        """
+        store = cls()
+        store.shm = shared_memory.SharedMemory(name=spec["name"])
+        for name, dtype, dims, offset in spec["layout"]:
+            store.arrays[name] = numpy.ndarray(dims, dtype=dtype, buffer=store.shm.buf, offset=offset)
+        return store
+
+    def close(self,
+              unlink: bool = False,
+              ):
+        """
+        Stop using the shared memory.
+
+        Args:
+            unlink (bool): Whether to also free the shared memory, which
+                only the process that created it should do
+        """
+        if self.shm is None:
+            return
+        # The arrays use the shared memory, so copy them first
+        self.arrays = {name: array.copy() for name, array in self.arrays.items()}
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+        self.shm = None
+
+    def select(self,
+               indexes: numpy.ndarray,
+               ):
+        """
+        Get a view of some of the features. The view shares the arrays
+        and the features already built.
+
+        Args:
+            indexes (numpy.ndarray): The features to select
+
+        Returns:
+            (FeatureStore): The selected features
+        """
+        view = copy.copy(self)
+        view.index = numpy.asarray(indexes)
+        return view
+
+    def __getstate__(self) -> dict:
+        """
+        The features and geometries already built aren't sent to
+        other processes, as they can be built again from the arrays.
+
+        Returns:
+            (dict): The state to pickle
+        """
+        state = dict(self.__dict__)
+        state["strings"] = dict()
+        state["features"] = dict()
+        state["cache"] = dict()
+        return state
+
+    def __iter__(self):
+        """
+        Returns:
+            (generator): Each feature in this view
+        """
+        for index in range(len(self)):
+            yield self[index]
+
+    def __len__(self) -> int:
+        """
+        Returns:
+            (int): The number of features
+        """
+        if self.index is not None:
+            return len(self.index)
+        return len(self.arrays["types"])
+
+    def string(self,
+               index: int,
+               ) -> str:
+        """
+        Get a string from the dictionary.
+
+        Args:
+            index (int): The index of the string
+
+        Returns:
+            (str): The string
+        """
+        if index not in self.strings:
+            offsets = self.arrays["stringoffsets"]
+            self.strings[index] = self.arrays["strings"][offsets[index]:offsets[index + 1]].tobytes().decode("utf-8")
+        return self.strings[index]
+
+    def tagValues(self,
+                  key: str,
+                  ) -> list:
+        """
+        Get the value of one tag for every feature, without building
+        the features.
+
+        Args:
+            key (str): The tag to get
+
+        Returns:
+            (list): The value for each feature, or None if it doesn't have the tag
+        """
+        values = [None] * len(self.arrays["types"])
+        for keyid in numpy.unique(self.arrays["keys"]):
+            if self.string(keyid) != key:
+                continue
+            positions = numpy.flatnonzero(self.arrays["keys"] == keyid)
+            owners = numpy.searchsorted(self.arrays["tags"], positions, side="right") - 1
+            for owner, value in zip(owners, self.arrays["values"][positions]):
+                if value < 0:
+                    offsets = self.arrays["refoffsets"]
+                    values[owner] = self.arrays["refs"][offsets[owner]:offsets[owner + 1]].tolist()
+                else:
+                    values[owner] = json.loads(self.string(value))
+        if self.index is not None:
+            values = [values[index] for index in self.index]
+
+        return values
+
+    def records(self,
+                keys: list,
+                ) -> list:
+        """
+        Get a FeatureRecord for every feature, without building the
+        features.
+
+        Args:
+            keys (list): The tags used for matching
+
+        Returns:
+            (list): The records
+        """
+        counts = numpy.diff(self.arrays["tags"])
+        types = self.arrays["types"]
+        refoffsets = self.arrays["refoffsets"]
+        indexes = self.index if self.index is not None else range(len(types))
+        ids = self.tagValues("id")
+        versions = self.tagValues("version")
+        values = [self.tagValues(key) for key in keys]
+        records = list()
+        for position, index in enumerate(indexes):
+            tags = dict()
+            for key, value in zip(keys, values):
+                if value[position] is not None:
+                    tags[key] = value[position]
+            refs = None
+            if refoffsets[index + 1] > refoffsets[index]:
+                refs = self.arrays["refs"][refoffsets[index]:refoffsets[index + 1]]
+            records.append(FeatureRecord(position, ids[position], versions[position], int(types[index]),
+                                         int(counts[index]), tags, refs))
+
+        return records
+
+    def __getitem__(self,
+                    index: int,
+                    ) -> Feature:
+        """
+        Get a feature, building it from the arrays the first time.
+
+        Args:
+            index (int): The index of the feature
+
+        Returns:
+            (Feature): The feature
+        """
+        if self.index is not None:
+            index = self.index[index]
+        index = int(index)
+        if index in self.features:
+            return self.features[index]
+
+        properties = dict()
+        start, end = self.arrays["tags"][index:index + 2]
+        for key, value in zip(self.arrays["keys"][start:end], self.arrays["values"][start:end]):
+            if value < 0:
+                offsets = self.arrays["refoffsets"]
+                properties[self.string(key)] = self.arrays["refs"][offsets[index]:offsets[index + 1]].tolist()
+            else:
+                properties[self.string(key)] = json.loads(self.string(value))
+        feature = Feature(geometry=self.geometries(numpy.array([index]), True)[0], properties=properties)
+        self.features[index] = feature
+
+        return feature
+
+    def bounds(self) -> numpy.ndarray:
+        """
+        Get the bounding boxes of the geometries in this view, without
+        building them.
+
+        Returns:
+            (numpy.ndarray): The minx, miny, maxx and maxy of each feature
+        """
+        if self.index is not None:
+            return self.arrays["bounds"][self.index]
+        return self.arrays["bounds"]
+
+    def types(self) -> numpy.ndarray:
+        """
+        Get the geometry types in this view, without building them.
+
+        Returns:
+            (numpy.ndarray): The shapely geometry type ID of each feature
+        """
+        if self.index is not None:
+            return self.arrays["types"][self.index]
+        return self.arrays["types"]
+
+    def geometries(self,
+                   indexes: numpy.ndarray = None,
+                   absolute: bool = False,
+                   ) -> numpy.ndarray:
+        """
+        Get the shapely geometries, in the same coordinates as the
+        features. The geometries are built from the WKB the first time
+        they're used, and reused after that.
+
+        Args:
+            indexes (numpy.ndarray): The features to get, defaults to all in this view
+            absolute (bool): Whether the indexes are into the whole dataset instead of this view
+
+        Returns:
+            (numpy.ndarray): The geometries
+        """
+        types = self.arrays["types"]
+        if "geoms" not in self.cache:
+            self.cache["geoms"] = numpy.empty(len(types), dtype=object)
+            self.cache["built"] = numpy.zeros(len(types), dtype=bool)
+        if indexes is None:
+            indexes = self.index
+            absolute = True
+        if indexes is None:
+            indexes = numpy.arange(len(types))
+        indexes = numpy.asarray(indexes, dtype=numpy.int64)
+        if not absolute and self.index is not None:
+            indexes = self.index[indexes]
+
+        geoms = self.cache["geoms"]
+        built = self.cache["built"]
+        missing = numpy.unique(indexes[~built[indexes]])
+        missing = missing[types[missing] >= 0]
+        if len(missing) > 0:
+            geoms[missing] = self.unpack("wkb", missing)
+        built[indexes] = True
+
+        return geoms[indexes]
+
+    def projected(self,
+                  indexes: numpy.ndarray = None,
+                  absolute: bool = False,
+                  ) -> numpy.ndarray:
+        """
+        Get the geometries in meters, if they were stored. These aren't
+        kept, as whatever uses them keeps them.
+
+        Args:
+            indexes (numpy.ndarray): The features to get, defaults to all in this view
+            absolute (bool): Whether the indexes are into the whole dataset instead of this view
+
+        Returns:
+            (numpy.ndarray): The geometries
+        """
+        if indexes is None:
+            indexes = self.index
+            absolute = True
+        if indexes is None:
+            indexes = numpy.arange(len(self.arrays["types"]))
+        indexes = numpy.asarray(indexes, dtype=numpy.int64)
+        if not absolute and self.index is not None:
+            indexes = self.index[indexes]
+
+        geoms = numpy.empty(len(indexes), dtype=object)
+        valid = self.arrays["types"][indexes] >= 0
+        geoms[valid] = self.unpack("projected", indexes[valid])
+        return geoms
+
+    def unpack(self,
+               name: str,
+               indexes: numpy.ndarray,
+               ) -> numpy.ndarray:
+        """
+        Build shapely geometries from one of the WKB arrays.
+
+        Args:
+            name (str): The name of the array
+            indexes (numpy.ndarray): The features to build
+
+        Returns:
+            (numpy.ndarray): The geometries
+        """
+        blob = self.arrays[name]
+        offsets = self.arrays[f"{name}offsets"]
+        return shapely.from_wkb([blob[offsets[i]:offsets[i + 1]].tobytes() for i in indexes])
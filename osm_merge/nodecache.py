@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2024 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+#
+# This stores the coordinates of every node in an OSM file, so the ways
+# can be turned into LineStrings. A statewide extract has tens of millions
+# of nodes, so they can be put in memory mapped files instead of memory,
+# and the files reused the next time the same extract is read.
+#
+
+import logging
+import array
+import json
+import os
+from pathlib import Path
+import numpy
+
+# Instantiate logger
+log = logging.getLogger(__name__)
+
+# How many nodes are buffered before writing them to the cache files
+CHUNK = 1 << 16
+
+class NodeCache(object):
+    def __init__(self,
+                 directory: str = None,
+                 source: str = None,
+                 ):
+        """
+        This class stores node ids and coordinates in arrays sorted by
+        node id. If a directory is given, the arrays are written to
+        files in it and memory mapped, so the OS decides what stays in
+        memory. If the files were made from the same source file, they
+        are used as is, and any nodes added are ignored.
+
+        Args:
+            directory (str): The directory for the cache files, or None to keep them in memory
+            source (str): The OSM file the nodes are from
+
+        Returns:
+            (NodeCache): An instance of this object
+        """
+        self.directory = directory
+        self.buffer = array.array("q")
+        self.coordbuffer = array.array("d")
+        self.ids = numpy.empty(0, dtype=numpy.int64)
+        self.coords = numpy.empty((0, 2), dtype=numpy.float64)
+        self.count = 0
+        self.finished = 0
+        self.valid = False
+        if directory is None:
+            return
+
+        os.makedirs(directory, exist_ok=True)
+        self.idsfile = f"{directory}/nodes.ids"
+        self.coordsfile = f"{directory}/nodes.coords"
+        self.infofile = f"{directory}/nodes.json"
+        stat = os.stat(source)
+        self.info = {"source": str(Path(source).resolve()),
+                     "size": stat.st_size,
+                     "mtime": stat.st_mtime_ns,
+                     }
+        if os.path.exists(self.infofile):
+            with open(self.infofile, "r") as file:
+                info = json.load(file)
+            count = info.pop("count")
+            self.valid = info == self.info and os.path.exists(self.idsfile)
+        if self.valid:
+            log.info(f"Using the {count} cached nodes in {directory}")
+            self.count = self.finished = count
+            self.open()
+            return
+
+        # Remove the info file first, so an interrupted run can't leave
+        # behind something that looks like it's finished.
+        if os.path.exists(self.infofile):
+            os.remove(self.infofile)
+        open(self.idsfile, "wb").close()
+        open(self.coordsfile, "wb").close()
+
+    def __len__(self):
+        return self.count
+
+    def open(self):
+        """
+        Memory map the cache files.
+        """
+        if self.count == 0:
+            self.ids = numpy.empty(0, dtype=numpy.int64)
+            self.coords = numpy.empty((0, 2), dtype=numpy.float64)
+            return
+        self.ids = numpy.memmap(self.idsfile, dtype=numpy.int64, mode="r")
+        self.coords = numpy.memmap(self.coordsfile, dtype=numpy.float64, mode="r").reshape(-1, 2)
+
+    def add(self,
+            nodeid: int,
+            lon: float,
+            lat: float,
+            ):
+        """
+        Add a node to the cache.
+
+        Args:
+            nodeid (int): The node id
+            lon (float): The longitude
+            lat (float): The latitude
+        """
+        if self.valid:
+            return
+        self.buffer.append(nodeid)
+        self.coordbuffer.extend((lon, lat))
+        self.count += 1
+        if self.directory is not None and len(self.buffer) >= CHUNK:
+            self.flush()
+
+    def extend(self,
+               ids: numpy.ndarray,
+               coords: numpy.ndarray,
+               ):
+        """
+        Add many nodes to the cache.
+
+        Args:
+            ids (numpy.ndarray): The node ids
+            coords (numpy.ndarray): The longitude and latitude of each node
+        """
+        if self.valid:
+            return
+        self.buffer.frombytes(numpy.ascontiguousarray(ids, dtype=numpy.int64).tobytes())
+        self.coordbuffer.frombytes(numpy.ascontiguousarray(coords, dtype=numpy.float64).tobytes())
+        self.count += len(ids)
+        if self.directory is not None and len(self.buffer) >= CHUNK:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered nodes to the cache files.
+        """
+        with open(self.idsfile, "ab") as file:
+            self.buffer.tofile(file)
+        with open(self.coordsfile, "ab") as file:
+            self.coordbuffer.tofile(file)
+        del self.buffer[:]
+        del self.coordbuffer[:]
+
+    def finish(self):
+        """
+        Sort the nodes added so far by id, so they can be looked up.
+        Files from OSM are already sorted by node id, so usually
+        this only checks that they are.
+        """
+        if self.finished == self.count:
+            return
+        if self.directory is not None:
+            self.flush()
+            self.open()
+        else:
+            ids = numpy.frombuffer(self.buffer, dtype=numpy.int64)
+            coords = numpy.frombuffer(self.coordbuffer, dtype=numpy.float64).reshape(-1, 2)
+            self.ids = numpy.concatenate((self.ids, ids))
+            self.coords = numpy.concatenate((self.coords, coords))
+            del ids, coords
+            del self.buffer[:]
+            del self.coordbuffer[:]
+
+        # Check in blocks so a memory mapped file isn't read all at once
+        ordered = True
+        for start in range(0, len(self.ids), CHUNK):
+            if (numpy.diff(self.ids[start:start + CHUNK + 1]) < 0).any():
+                ordered = False
+                break
+        if not ordered:
+            log.debug("The nodes aren't sorted by id, sorting them")
+            order = numpy.argsort(self.ids, kind="stable")
+            ids = self.ids[order]
+            coords = self.coords[order]
+            if self.directory is not None:
+                self.ids = self.coords = None
+                ids.tofile(self.idsfile)
+                coords.tofile(self.coordsfile)
+                self.open()
+            else:
+                self.ids = ids
+                self.coords = coords
+
+        if self.directory is not None:
+            with open(self.infofile, "w") as file:
+                json.dump({**self.info, "count": self.count}, file)
+        self.finished = self.count
+
+    def locations(self,
+                  refs: list,
+                  ) -> tuple:
+        """
+        Get the coordinates of nodes.
+
+        Args:
+            refs (list): The node ids
+
+        Returns:
+            (tuple): The coordinates of the nodes that were found, and
+                which of the nodes were found
+        """
+        self.finish()
+        refs = numpy.asarray(refs, dtype=numpy.int64)
+        positions = numpy.searchsorted(self.ids, refs)
+        positions[positions == len(self.ids)] = 0
+        if len(self.ids) > 0:
+            found = self.ids[positions] == refs
+        else:
+            found = numpy.zeros(len(refs), dtype=bool)
+        return numpy.asarray(self.coords[positions[found]]), found
@@ -22,9 +22,9 @@ import os
 import re
 from sys import argv
 from osm_fieldwork.osmfile import OsmFile
-from geojson import Point, Feature, FeatureCollection, dump, Polygon, load
+from geojson import Point, FeatureCollection, dump, Polygon, load
 import geojson
-from shapely.geometry import shape, LineString, Polygon, mapping
+from shapely.geometry import shape, Polygon, mapping
 import shapely
 from codetiming import Timer
 from cpuinfo import get_cpu_info
@@ -39,6 +39,7 @@ from numpy.linalg import norm
 import math
 import numpy
 import subprocess
+import json
 
 # Instantiate logger
 log = logging.getLogger(__name__)
@@ -49,12 +50,138 @@ info = get_cpu_info()
 # still reasonable.
 cores = info['count']
 
+# How much of the file is read at a time
+BLOCK_SIZE = 1024 * 1024
+
+def strictNumber(constant: str):
+    """
+    Don't accept NaN or Infinity in a GeoJson file, as geojson.load()
+    doesn't either.
+
+    Args:
+        constant (str): The constant json found, NaN, Infinity or -Infinity
+
+    Returns:
+        Nothing, as this always raises ValueError
+    """
+    raise ValueError(f"Number {constant} is not JSON compliant")
+
+def streamFeatures(file,
+                   size: int = None,
+                   ):
+    """
+    Read the features from a GeoJson file one at a time, so the whole
+    file never has to be in memory. This works for both pretty printed
+    and compact files, as it parses the JSON instead of splitting lines.
+    The features are the same as what geojson.load() makes.
+
+    Args:
+        file: The GeoJson file, either a filespec or an open file
+        size (int): If given, return lists of up to this many features
+
+    Returns:
+        (generator): The features, or lists of features
+    """
+    if isinstance(file, (str, Path)):
+        with open(file, "r") as infile:
+            yield from streamFeatures(infile, size)
+        return
+    if size is not None:
+        batch = list()
+        for feature in streamFeatures(file):
+            batch.append(feature)
+            if len(batch) == size:
+                yield batch
+                batch = list()
+        if len(batch) > 0:
+            yield batch
+        return
+
+    decoder = json.JSONDecoder(object_hook=geojson.GeoJSON.to_instance,
+                               parse_constant=strictNumber)
+    buffer = str()
+    pos = 0
+    eof = False
+
+    def more() -> bool:
+        nonlocal buffer, pos, eof
+        if eof:
+            return False
+        # Drop what's been parsed already
+        buffer = buffer[pos:]
+        pos = 0
+        # Read more each time a value doesn't fit, so a huge
+        # feature isn't parsed again for every block.
+        block = file.read(max(BLOCK_SIZE, len(buffer)))
+        if len(block) == 0:
+            eof = True
+            return False
+        buffer += block
+        return True
+
+    def skip() -> str:
+        # Skip the whitespace and return the next character
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if not more():
+                return str()
+
+    def value():
+        nonlocal pos
+        skip()
+        while True:
+            try:
+                data, end = decoder.raw_decode(buffer, pos)
+                # A number at the end of the buffer may not be complete
+                if end < len(buffer) or eof:
+                    pos = end
+                    return data
+            except json.JSONDecodeError as error:
+                if eof:
+                    raise error
+            if not more():
+                data, pos = decoder.raw_decode(buffer, pos)
+                return data
+
+    def expect(chars: str) -> str:
+        nonlocal pos
+        char = skip()
+        if char == str() or char not in chars:
+            raise ValueError(f"Expected one of {chars} at {char!r} in the GeoJson file")
+        pos += 1
+        return char
+
+    # Only the features array of the top level object is read, the
+    # other values are parsed and dropped.
+    expect("{")
+    if skip() == "}":
+        return
+    while True:
+        key = value()
+        expect(":")
+        if key != "features":
+            value()
+        elif expect("[") and skip() != "]":
+            while True:
+                yield value()
+                if expect(",]") == "]":
+                    break
+        else:
+            expect("]")
+        if expect(",}") == "}":
+            return
+
 class ReadGeojson(object):
     def __init__(self,
                  filespec: str = None,
                  read: bool = True,
                  ):
         self.file = None
+        self.features = None
         self.offset = 0
         self.size = 0
         if not filespec:
@@ -82,89 +209,10 @@ class ReadGeojson(object):
             log.error(f"You must supply a filename to read!")
             return
 
-        # Strip off the header
-        if self.offset == 0:
-            head = self.file.readline().strip()
-            while head.find("features") <= 0:
-                head = self.file.readline()
-
+        if self.features is None:
+            self.features = streamFeatures(self.file, size)
         self.offset += size
-        # This is the actual start of the data
-        line = self.file.readline().strip()
-
-        # spin = Bar('Processing...', max=size)
-        feature = str()
-        props = dict()
-        geom = None
-        coords = str()
-        features = list()
-        closed = 0
-        count = 0
-        while len(line) > 0:
-            # spin.next()
-            if count == size:
-                return features
-            else:
-                count += 1
-            # newlines are only used between features
-            if "properties" in line:
-                start = line.find("properties") + 13
-                end = line.find("},", start) + 1
-                properties = line[start:end].replace("null", "None")
-                props = eval(properties)
-
-                if line.find("coordinates") <= 0:
-                    # log.debug(f"Geometry is NULL!")
-                    line = self.file.readline().strip()
-                    continue
-                start = line.find("coordinates") + 16
-                end = line.find("}", start) - 4
-                coords = line[start:end]
-                lstr = list()
-                for gps in coords.replace("[ ", "").split(" ], "):
-                    tmp = gps.split(',')
-                    try:
-                        lstr.append([float(tmp[0]), float(tmp[1])])
-                    except:
-                        breakpoint()
-                geom = LineString(lstr)
-                features.append(Feature(geometry=geom, properties=props))
-                continue
-            else:
-                print(line.strip())
-                # if line == '{' or line == "{\n" or line.find("Feature") > 0:
-                if line.find("Feature") > 0:
-                    feature += line
-                    line = self.file.readline().strip()
-                    feature += line
-                    props = dict()
-                    continue
-                elif line == '},' or line == "},\n":
-                    # drop the trailing comma
-                    feature += line[:-1]
-                    # Get the properties
-                    if len(props) == 0 and feature.find("geometry") <= 0:
-                        props = eval(feature + '}')
-                        feature = str()
-                    elif len(props) > 0:
-                        feature += line
-                        print(feature)
-                    line = self.file.readline().strip()
-                    if geom is not None:
-                        features.append(Feature(geometry=geom, properties=props))
-                    continue
-                else:
-                    feature += line
-                    line = self.file.readline().strip()
-                continue
-            # line = self.file.readline()
-
-        #try:
-        #    self.file.seek(self.offset)
-        #except:
-        #    log.error(f"Couldn't seek to {self.offset}")
-
-        return features
+        return next(self.features, list())
 
     def writeFeatures(self,
                 features: list(),
@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2024 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+#
+# This remembers what the last conflation run did, so when there is a
+# new OSM extract or MVUM release, only the features that changed, or
+# are near something that changed, have to be conflated again.
+#
+
+import logging
+import hashlib
+import json
+import pickle
+import sqlite3
+import shapely
+from shapely import STRtree
+import numpy
+
+# Instantiate logger
+log = logging.getLogger(__name__)
+
+def featureHash(feature: dict) -> str:
+    """
+    Get a hash of the geometry and tags of a feature.
+
+    Args:
+        feature (dict): The GeoJson feature
+
+    Returns:
+        (str): The hash as hex
+    """
+    text = json.dumps([feature["geometry"], feature["properties"]], sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class RunStore(object):
+    def __init__(self,
+                 filespec: str,
+                 threshold: float,
+                 informal: bool,
+                 bruteforce: bool,
+                 ):
+        """
+        This class stores a hash of every feature from the last run in
+        an sqlite database, and the pickled output for each primary
+        feature.
+        Nothing from the last run is used if it had different options.
+
+        Args:
+            filespec (str): The database file
+            threshold (float): Threshold for distance calculations in meters
+            informal (bool): Whether to dump features in OSM not in external data
+            bruteforce (bool): Whether every feature is compared
+
+        Returns:
+            (RunStore): An instance of this object
+        """
+        self.db = sqlite3.connect(filespec)
+        self.db.execute("CREATE TABLE IF NOT EXISTS options (name TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS primaries (hash TEXT PRIMARY KEY, output BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS secondaries (hash TEXT PRIMARY KEY, minx REAL, miny REAL, maxx REAL, maxy REAL)")
+        # This run is put in new tables, which replace the old ones
+        # once it's finished.
+        self.db.execute("DROP TABLE IF EXISTS newprimaries")
+        self.db.execute("DROP TABLE IF EXISTS newsecondaries")
+        self.db.execute("CREATE TABLE newprimaries (hash TEXT PRIMARY KEY, output BLOB)")
+        self.db.execute("CREATE TABLE newsecondaries (hash TEXT PRIMARY KEY, minx REAL, miny REAL, maxx REAL, maxy REAL)")
+        self.db.commit()
+
+        self.options = json.dumps({"threshold": float(threshold),
+                                   "informal": bool(informal),
+                                   "bruteforce": bool(bruteforce),
+                                   })
+        row = self.db.execute("SELECT value FROM options WHERE name = 'options'").fetchone()
+        # In brute force mode every node is copied to the output of
+        # every primary feature, so nothing is local to a feature.
+        self.valid = row is not None and row[0] == self.options and not bruteforce
+        self.hashes = list()
+
+    def compare(self,
+                primary: list,
+                primarybounds: numpy.ndarray,
+                secondary: list,
+                secondarybounds: numpy.ndarray,
+                threshold: float,
+                ) -> numpy.ndarray:
+        """
+        Find the primary features that can use the output from the last
+        run. A feature can if it hasn't changed, and no secondary feature
+        within the threshold distance has been added, changed or deleted.
+
+        Args:
+            primary (list): The primary features
+            primarybounds (numpy.ndarray): The bounding box of each primary feature in meters
+            secondary (list): The secondary features
+            secondarybounds (numpy.ndarray): The bounding box of each secondary feature in meters
+            threshold (float): Threshold for distance calculations in meters
+
+        Returns:
+            (numpy.ndarray): The indexes of the primary features that haven't changed
+        """
+        self.hashes = [featureHash(feature) for feature in primary]
+        current = dict()
+        for feature, bounds in zip(secondary, secondarybounds):
+            current[featureHash(feature)] = bounds
+        self.db.executemany("INSERT OR REPLACE INTO newsecondaries VALUES (?, ?, ?, ?, ?)",
+                            [(key, *map(float, bounds)) for key, bounds in current.items()])
+        self.db.commit()
+        if not self.valid:
+            return numpy.array([], dtype=numpy.int64)
+
+        # Both the old and new versions of a changed feature are changes
+        previous = dict()
+        for key, *bounds in self.db.execute("SELECT * FROM secondaries"):
+            previous[key] = bounds
+        changed = [bounds for key, bounds in current.items() if key not in previous]
+        changed += [bounds for key, bounds in previous.items() if key not in current]
+        changed = numpy.array(changed, dtype=numpy.float64).reshape(-1, 4)
+        changed = changed[numpy.isfinite(changed).all(axis=1)]
+        log.info(f"{len(changed)} secondary features have changed since the last run")
+
+        done = set(key for key, in self.db.execute("SELECT hash FROM primaries"))
+        unchanged = numpy.array([key in done for key in self.hashes], dtype=bool)
+        finite = numpy.isfinite(primarybounds).all(axis=1)
+        if len(changed) > 0 and finite.any():
+            tree = STRtree(shapely.box(*changed.T))
+            nearby = numpy.flatnonzero(finite)
+            minx, miny, maxx, maxy = primarybounds[nearby].T
+            envelopes = shapely.box(minx - threshold, miny - threshold, maxx + threshold, maxy + threshold)
+            hits = tree.query(envelopes)
+            unchanged[nearby[hits[0]]] = False
+        log.info(f"{unchanged.sum()} of {len(primary)} primary features can use the last run")
+
+        return numpy.flatnonzero(unchanged)
+
+    def load(self,
+             indexes: numpy.ndarray,
+             ):
+        """
+        Get the output from the last run for primary features, and keep
+        it for the next run.
+
+        Args:
+            indexes (numpy.ndarray): The primary features
+
+        Returns:
+            (generator): The conflated features and the new features for
+                each primary feature
+        """
+        for index in indexes:
+            key = self.hashes[index]
+            self.db.execute("INSERT OR IGNORE INTO newprimaries SELECT * FROM primaries WHERE hash = ?", (key, ))
+            output, = self.db.execute("SELECT output FROM primaries WHERE hash = ?", (key, )).fetchone()
+            yield pickle.loads(output)
+        self.db.commit()
+
+    def record(self,
+               indexes: list,
+               data: list,
+               new: list,
+               spans: list,
+               ):
+        """
+        Save the output for a batch of primary features.
+
+        Args:
+            indexes (list): The indexes of the primary features in the batch
+            data (list): The conflated features
+            new (list): The features only in the primary dataset
+            spans (list): Where the output for each primary feature starts in data and new
+        """
+        rows = list()
+        for position, index in enumerate(indexes):
+            (datastart, newstart), (dataend, newend) = spans[position:position + 2]
+            # The conflated and new features can share the same tags,
+            # so they're pickled together to keep it that way.
+            output = (data[datastart:dataend], new[newstart:newend])
+            rows.append((self.hashes[index], pickle.dumps(output)))
+        self.db.executemany("INSERT OR REPLACE INTO newprimaries VALUES (?, ?)", rows)
+        self.db.commit()
+
+    def commit(self):
+        """
+        Replace the last run with this one, once it has finished.
+        """
+        self.db.execute("BEGIN")
+        self.db.execute("DROP TABLE primaries")
+        self.db.execute("DROP TABLE secondaries")
+        self.db.execute("ALTER TABLE newprimaries RENAME TO primaries")
+        self.db.execute("ALTER TABLE newsecondaries RENAME TO secondaries")
+        self.db.execute("INSERT OR REPLACE INTO options VALUES ('options', ?)", (self.options, ))
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2024 OpenStreetMap US
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+#
+# This decides which features to keep while loading a data file, so
+# features that will never be conflated don't use any memory. It uses
+# the same config files as the osm-rawdata project, so the same config
+# can be used for a database query or a file.
+#
+
+import logging
+from osm_rawdata.config import QueryConfig
+
+# Instantiate logger
+log = logging.getLogger(__name__)
+
+class TagFilter(object):
+    def __init__(self,
+                 config,
+                 ):
+        """
+        This class filters features by their tags, using a config file
+        in the osm-rawdata YAML or JSON format, parsed by osm-rawdata.
+        Only the tables and the tags are used, the tables to choose
+        nodes and/or ways, and the tags to choose the features. A tag
+        with no value matches any value.
+
+        Args:
+            config (str): A YAML or JSON config file, or the config parsed by QueryConfig
+
+        Returns:
+            (TagFilter): An instance of this object
+        """
+        if isinstance(config, dict):
+            self.config = config
+        elif config[-5:].lower() == ".json":
+            self.config = QueryConfig().parseJson(config)
+        else:
+            self.config = QueryConfig().parseYaml(config)
+
+        tables = self.config["tables"] or ["nodes", "ways_line", "ways_poly"]
+        self.nodes = "nodes" in tables
+        self.ways = "ways_line" in tables or "ways_poly" in tables
+
+        # Each entry is the tag, the values it can have, and whether
+        # it's joined with "or" or "and". QueryConfig puts the same tags
+        # in every table, so they're only used once.
+        self.tags = list()
+        for table in tables:
+            for entry in self.config["where"].get(table, list()):
+                op = entry.get("op") or "or"
+                for tag, values in entry.items():
+                    if tag == "op":
+                        continue
+                    values = set(self.values(values))
+                    # not null matches any value
+                    if "not null" in values:
+                        values = set()
+                    if (tag, values, op) not in self.tags:
+                        self.tags.append((tag, values, op))
+
+    def values(self,
+               values,
+               ) -> list:
+        """
+        Get the tag values from a config entry, which can be a value or
+        a list of them.
+
+        Args:
+            values (str|list): The values from the config
+
+        Returns:
+            (list): The values as strings
+        """
+        if values is None:
+            return list()
+        if not isinstance(values, list):
+            # yes is used in the tags instead of true
+            return ["yes" if values is True else str(values)]
+        result = list()
+        for value in values:
+            result.extend(self.values(value))
+        return result
+
+    def keys(self) -> list:
+        """
+        Get the tag keys this filter uses. A feature that doesn't have
+        any of them never matches, unless the filter has no tags.
+
+        Returns:
+            (list): The tag keys
+        """
+        return sorted(set(tag for tag, values, op in self.tags))
+
+    def matches(self,
+                tags: dict,
+                ) -> bool:
+        """
+        Check whether the tags match the filter.
+
+        Args:
+            tags (dict): The tags of a feature
+
+        Returns:
+            (bool): Whether the feature should be kept
+        """
+        ors = list()
+        for tag, values, op in self.tags:
+            value = tags.get(tag)
+            match = value is not None and value != "" and (len(values) == 0 or value in values)
+            if op == "and":
+                if not match:
+                    return False
+            else:
+                ors.append(match)
+        return len(ors) == 0 or any(ors)
+
+    def wants(self,
+              feature: dict,
+              ) -> bool:
+        """
+        Check whether a GeoJson feature should be kept.
+
+        Args:
+            feature (dict): The GeoJson feature
+
+        Returns:
+            (bool): Whether the feature should be kept
+        """
+        if feature["geometry"] is None:
+            return False
+        if feature["geometry"]["type"] == "Point":
+            if not self.nodes:
+                return False
+        elif not self.ways:
+            return False
+        return self.matches(feature["properties"])
@@ -30,6 +30,7 @@ from sys import argv
 from osm_fieldwork.osmfile import OsmFile
 from geojson import Point, Feature, FeatureCollection, dump, Polygon, load
 import geojson
+from osm_merge.readjson import streamFeatures
 from shapely.geometry import shape, LineString, Polygon, mapping
 import shapely
 from shapely.ops import transform
@@ -43,7 +44,8 @@ from thefuzz import fuzz, process
 from pathlib import Path
 from tqdm import tqdm
 import tqdm.asyncio
-from progress.bar import Bar, PixelBar
+from progress.bar import PixelBar
+from progress.spinner import Spinner
 from osm_merge.yamlfile import YamlFile
 
 import osm_merge as om
@@ -91,19 +93,16 @@ class MVUM(object):
                 filespec: str = None,
                 ) -> list:
 
-        # FIXME: read in the whole file for now
         if filespec is not None:
             file = open(filespec, "r")
         else:
             file = self.file
 
-        data = geojson.load(file)
-
-        spin = Bar('Processing...', max=len(data['features']))
+        spin = Spinner('Processing...')
 
         highways = list()
         config = self.yaml.getEntries()
-        for entry in data["features"]:
+        for entry in streamFeatures(file):
             spin.next()
             geom = entry["geometry"]
             id = 0
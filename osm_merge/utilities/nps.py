@@ -23,6 +23,7 @@ from sys import argv
 from osm_fieldwork.osmfile import OsmFile
 from geojson import Point, Feature, FeatureCollection, dump, Polygon, load
 import geojson
+from osm_merge.readjson import streamFeatures
 from shapely.geometry import shape, LineString, Polygon, mapping
 import shapely
 from shapely.ops import transform
@@ -77,16 +78,13 @@ class NPS(object):
             state (str): The 2 letter state abbreviation
 
         """
-        # FIXME: read in the whole file for now
         if filespec is not None:
             file = open(filespec, "r")
         else:
             file = self.file
 
-        data = geojson.load(file)
-
         highways = list()
-        for entry in data["features"]:
+        for entry in streamFeatures(file):
             geom = entry["geometry"]
             props = dict()
             if "MAPSOURCE" in entry["properties"]:
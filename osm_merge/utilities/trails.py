@@ -29,6 +29,7 @@ from sys import argv
 from osm_fieldwork.osmfile import OsmFile
 from geojson import Point, Feature, FeatureCollection, dump, Polygon, load
 import geojson
+from osm_merge.readjson import streamFeatures
 from shapely.geometry import shape, LineString, Polygon, mapping
 import shapely
 from shapely.ops import transform
@@ -42,7 +43,8 @@ from thefuzz import fuzz, process
 from pathlib import Path
 from tqdm import tqdm
 import tqdm.asyncio
-from progress.bar import Bar, PixelBar
+from progress.bar import PixelBar
+from progress.spinner import Spinner
 
 # Instantiate logger
 log = logging.getLogger(__name__)
@@ -67,17 +69,14 @@ class Trails(object):
                 filespec: str = None,
                 ) -> list:
 
-        # FIXME: read in the whole file for now
         if filespec is not None:
             file = open(filespec, "r")
         else:
             file = self.file
 
-        data = geojson.load(file)
-
         highways = list()
-        spin = Bar('Processing...', max=len(data["features"]))
-        for entry in data["features"]:
+        spin = Spinner('Processing...')
+        for entry in streamFeatures(file):
             spin.next()
             geom = entry["geometry"]
             props = dict()
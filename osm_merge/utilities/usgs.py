@@ -23,13 +23,15 @@ from sys import argv
 from osm_fieldwork.osmfile import OsmFile
 from geojson import Point, Feature, FeatureCollection, dump, Polygon, load
 import geojson
+from osm_merge.readjson import streamFeatures
 from shapely.geometry import shape, LineString, Polygon, mapping
 import shapely
 import asyncio
 from codetiming import Timer
 from time import sleep
 from pathlib import Path
-from progress.bar import Bar, PixelBar
+from progress.bar import PixelBar
+from progress.spinner import Spinner
 
 # ogrmerge.py -single -o trails.shp VECTOR_*/Shape/Trans_TrailSegment.shp
 
@@ -62,17 +64,14 @@ class USGS(object):
             state (str): The 2 letter state abbreviation
 
         """
-        # FIXME: read in the whole file for now
         if filespec is not None:
             file = open(filespec, "r")
         else:
             file = self.file
 
-        data = geojson.load(file)
-
         highways = list()
-        spin = Bar('Processing...', max=len(data['features']))
-        for entry in data["features"]:
+        spin = Spinner('Processing...')
+        for entry in streamFeatures(file):
             geom = entry["geometry"]
             props = dict()
             spin.next()
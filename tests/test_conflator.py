@@ -0,0 +1,560 @@
+# Copyright (c) 2024 OpenStreetMap US
+#
+# This file is part of osm-merge.
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with osm-merge.  If not, see <https:#www.gnu.org/licenses/>.
+#
+"""Tests for the highway conflation engine."""
+
+import copy
+import geojson
+import json
+import os
+import re
+
+import numpy
+import osmium
+import pytest
+import shapely
+
+from shapely.geometry import MultiLineString
+from thefuzz import fuzz
+
+from osm_merge.conflator import (
+    MATCH_THRESHOLD,
+    Batches,
+    Conflator,
+    cachedRatio,
+    conflateThread,
+    findRanges,
+    fuzzyRatio,
+    getEndpoints,
+    normalizeRef,
+    partitionData,
+    prepareSecondary,
+    projectGeometries,
+    RatioMatrix,
+    ResultWriter,
+)
+from osm_merge.conflatePOI import ConflatePOI
+from osm_merge.featurestore import FeatureStore
+from osm_merge.nodecache import NodeCache
+from osm_merge.readjson import streamFeatures
+from osm_merge.runstore import RunStore
+from osm_merge.tagfilter import TagFilter
+
+rootdir = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_spatial_index():
+    """The spatial index should find the same matches as brute force."""
+    conflate = Conflator()
+    primary = conflate.parseFile(f"{rootdir}/data/mvum-test.geojson")
+    secondary = conflate.parseFile(f"{rootdir}/data/osm.osm")
+    brute = conflateThread(primary, secondary, threshold=7.0, bruteforce=True)
+    # A match on the reference number is final, while brute force may
+    # see other features first, so only the spatial index is compared.
+    prepared = prepareSecondary(secondary)
+    prepared["refs"] = dict()
+    indexed = conflateThread(primary, secondary, threshold=7.0, prepared=prepared)
+    # Nodes are only copied to the output by the brute force search
+    ways = [entry for entry in brute[0] if entry["geometry"] is None or entry["geometry"]["type"] != "Point"]
+    assert indexed[0] == ways
+    assert indexed[1] == brute[1]
+
+
+def test_ref_match(monkeypatch):
+    """A feature matched by its reference number shouldn't check everything nearby again."""
+    conflate = Conflator()
+    primary = conflate.parseFile(f"{rootdir}/data/mvum-test.geojson")
+    secondary = conflate.parseFile(f"{rootdir}/data/osm.osm")
+    prepared = prepareSecondary(secondary)
+    refs = [entry for entry in primary if normalizeRef(entry["properties"].get("ref:usfs", "")) in prepared["refs"]]
+    assert len(refs) > 0
+    rescans = list()
+    getRatios = Conflator.getRatios
+    def counter(self, feature, records):
+        rescans.append(feature)
+        return getRatios(self, feature, records)
+    monkeypatch.setattr(Conflator, "getRatios", counter)
+    conflateThread(refs, secondary, threshold=7.0, prepared=prepared)
+    assert rescans == []
+
+
+def test_poi_ratios():
+    """The batched POI ratios should match thefuzz, and not change checkTags()."""
+    poi = ConflatePOI()
+    feature = {"tags": {"name": "Sunrise Campground", "amenity": "camp_site", "note": "Near the lake"}}
+    entries = [{"tags": {"name": "Sunrise Campgrund", "amenity": "camp_site", "dist": 1.0}},
+               {"tags": {"name": "Sunset Camp", "note": "Near the lake", "dist": 2.0}},
+               {"tags": {"amenity": "toilets", "dist": 3.0}},
+               {"tags": {"name": "Sunrise Campground", "dist": 20.0}},
+               ]
+    ratios = poi.getRatios(feature, entries)
+    assert len(ratios) == len(entries)
+    for ratio, entry in zip(ratios, entries):
+        assert sorted(ratio) == sorted(key for key in feature["tags"] if key in entry["tags"])
+        for key, value in ratio.items():
+            expected = int(round(fuzz.ratio(feature["tags"][key], entry["tags"][key])))
+            # Anything under the threshold isn't a match either way
+            assert value == expected or (value == 0 and expected <= 80)
+        before = poi.checkTags(feature, copy.deepcopy(entry))
+        assert poi.checkTags(feature, copy.deepcopy(entry), ratio) == before
+    assert poi.getRatios(feature, [{"tags": {"dist": 1.0}}]) == [dict()]
+
+
+def test_indexed_nodes(tmp_path):
+    """Only brute force copies the nodes, which doesn't change the OSM XML output."""
+    conflate = Conflator()
+    primary = conflate.parseFile(f"{rootdir}/data/topo-test.geojson")[:3]
+    secondary = conflate.parseFile(f"{rootdir}/data/osm.osm")
+    nodes = [feature for feature in secondary if feature["geometry"]["type"] == "Point"]
+    assert nodes
+    brute = conflateThread(primary, copy.deepcopy(secondary), threshold=7.0, bruteforce=True)
+    indexed = conflateThread(primary, copy.deepcopy(secondary), threshold=7.0)
+    copied = [entry for entry in brute[0] if entry["geometry"] is not None and entry["geometry"]["type"] == "Point"]
+    assert copied[:len(nodes)] == nodes
+    assert not any(entry["geometry"] is not None and entry["geometry"]["type"] == "Point" for entry in indexed[0])
+    conflate.writeOSM(brute[0], f"{tmp_path}/brute.osm")
+    conflate.writeOSM(indexed[0], f"{tmp_path}/indexed.osm")
+    with open(f"{tmp_path}/brute.osm") as first, open(f"{tmp_path}/indexed.osm") as second:
+        # The timestamps are when the file was written
+        assert re.sub("timestamp='[^']*'", "", first.read()) == re.sub("timestamp='[^']*'", "", second.read())
+
+
+def test_ref_index():
+    """The features should be indexed by reference number."""
+    assert normalizeRef("FR 502.1a") == normalizeRef("FS 502.1A") == "502.1A"
+    conflate = Conflator()
+    secondary = conflate.parseFile(f"{rootdir}/data/osm.osm")
+    refs = prepareSecondary(secondary)["refs"]
+    assert refs
+    for ref, indexes in refs.items():
+        for index in indexes:
+            assert normalizeRef(secondary[index]["properties"]["ref:usfs"]) == ref
+    assert prepareSecondary(FeatureStore(secondary))["refs"] == refs
+
+
+def test_batch_ratios():
+    """The batch ratios should match the ones for one pair at a time."""
+    conflate = Conflator()
+    primary = conflate.parseFile(f"{rootdir}/data/mvum-test.geojson")
+    secondary = [feature for feature in conflate.parseFile(f"{rootdir}/data/osm.osm") if "name" in feature["properties"]]
+    records = prepareSecondary(secondary)["records"]
+    matrix = RatioMatrix(primary, records)
+    for entry in primary:
+        assert matrix.ratios(entry, records[::-1]) == conflate.getRatios(entry, records[::-1])
+        for existing, ratios in zip(secondary, conflate.getRatios(entry, records)):
+            for key, ratio in ratios.items():
+                expected = fuzzyRatio(entry["properties"][key], existing["properties"][key])
+                if expected > MATCH_THRESHOLD:
+                    assert ratio == expected
+                else:
+                    assert ratio == 0
+
+
+def test_ratio_cache():
+    """Repeated comparisons should come from the cache, either way around."""
+    cachedRatio.cache_clear()
+    expected = fuzz.ratio("king solomon road", "king solomon rd")
+    assert fuzzyRatio("King Solomon Road", "King Solomon Rd") == expected
+    assert cachedRatio.cache_info().misses == 1
+    assert fuzzyRatio("King Solomon Road", "King Solomon Rd") == expected
+    assert fuzzyRatio("king solomon rd", "KING SOLOMON ROAD") == expected
+    info = cachedRatio.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (2, 1, 1)
+
+
+def test_batch_distance():
+    """The batch distances should be the same as one pair at a time."""
+    conflate = Conflator()
+    primary = conflate.parseFile(f"{rootdir}/data/topo-test.geojson")
+    secondary = conflate.parseFile(f"{rootdir}/data/osm.osm")[-200:]
+    newgeoms = projectGeometries(primary)
+    oldgeoms = projectGeometries(secondary)
+    # MultiLineStrings are split into segments
+    primary.append(primary[0])
+    newgeoms = list(newgeoms) + [MultiLineString([newgeoms[0], newgeoms[1]])]
+    for entry, newobj in zip(primary, newgeoms):
+        dists = conflate.getDistances(newobj, oldgeoms)
+        for existing, oldobj, dist in zip(secondary, oldgeoms, dists):
+            assert dist == conflate.getDistance(entry, existing, newobj, oldobj)
+
+
+def test_batch_slope():
+    """The batch slopes should be the same as one pair at a time."""
+    conflate = Conflator()
+    primary = conflate.parseFile(f"{rootdir}/data/mvum-test.geojson")
+    secondary = conflate.parseFile(f"{rootdir}/data/osm.osm")[-200:]
+    newgeoms = projectGeometries(primary)
+    oldgeoms = projectGeometries(secondary)
+    newends = getEndpoints(newgeoms)
+    oldends = getEndpoints(oldgeoms)
+    for entry, newobj, newpoints in zip(primary, newgeoms, newends):
+        slopes, angles = conflate.getSlopes(newpoints, oldends)
+        for existing, oldobj, slope, angle in zip(secondary, oldgeoms, slopes, angles):
+            assert (slope, angle) == pytest.approx(conflate.getSlope(entry, existing, newobj, oldobj), abs=1e-9)
+
+
+def test_partition():
+    """Splitting the data into tiles should find the same matches."""
+    conflate = Conflator()
+    primary = conflate.parseFile(f"{rootdir}/data/topo-test.geojson")
+    secondary = conflate.parseFile(f"{rootdir}/data/osm.osm")
+    whole = conflateThread(primary, secondary, threshold=7.0)
+    data = list()
+    new = list()
+    blocks = partitionData(primary, secondary, 7.0, 4)
+    assert len(blocks) > 1
+    for tile, nearby in blocks:
+        assert len(nearby) < len(secondary)
+        result = conflateThread([primary[index] for index in tile], [secondary[index] for index in nearby], threshold=7.0)
+        data += result[0]
+        new += result[1]
+    assert sorted(map(str, data)) == sorted(map(str, whole[0]))
+    assert sorted(map(str, new)) == sorted(map(str, whole[1]))
+
+
+def test_shared_memory():
+    """The secondary dataset in shared memory should find the same matches."""
+    conflate = Conflator()
+    primary = conflate.parseFile(f"{rootdir}/data/mvum-test.geojson")
+    secondary = conflate.parseFile(f"{rootdir}/data/osm.osm")
+    whole = conflateThread(primary, secondary, threshold=7.0)
+    store = FeatureStore(secondary)
+    shared = FeatureStore.attach(store.share())
+    try:
+        assert str(shared[len(secondary) - 1]) == str(secondary[-1])
+        assert conflateThread(primary, shared, threshold=7.0) == whole
+    finally:
+        shared.close()
+        store.close(True)
+
+
+def test_shared_memory_error(tmp_path):
+    """The shared memory should be freed when a worker fails."""
+    # A feature with no geometry makes the worker raise an exception
+    with open(f"{tmp_path}/broken.geojson", "w") as file:
+        json.dump({"type": "FeatureCollection", "features": [{"type": "Feature", "geometry": None, "properties": {}}]}, file)
+    before = set(os.listdir("/dev/shm"))
+    with pytest.raises(Exception):
+        Conflator().conflateData(f"{tmp_path}/broken.geojson", f"{rootdir}/data/osm.osm", 7.0, sharemem=True)
+    assert set(os.listdir("/dev/shm")) <= before
+
+
+def test_batches():
+    """Every primary feature should be in exactly one batch."""
+    tiles = [(numpy.arange(0, 37), None), (numpy.arange(37, 38), numpy.arange(5)), (numpy.arange(38, 101), None)]
+    batches = Batches(tiles, 3)
+    indexes = list()
+    while (batch := batches.next()) is not None:
+        number, tile, primary, secondary = batch
+        assert len(primary) > 0
+        assert secondary is tiles[tile][1]
+        indexes += primary.tolist()
+        # A slow odd sized batch next, so the last one is a partial batch
+        batches.update(number, len(primary), {"pid": 1, "seconds": len(primary) * 2.0 / 7, "cache": dict()})
+    assert sorted(indexes) == list(range(101))
+
+
+def test_result_writer(tmp_path):
+    """Writing the output in batches should make the same files."""
+    conflate = Conflator()
+    primary = conflate.parseFile(f"{rootdir}/data/topo-test.geojson")
+    conflate.writeGeoJson(primary, f"{tmp_path}/all.geojson")
+    writer = ResultWriter(conflate, f"{tmp_path}/batches.geojson")
+    writer.write(list(), primary[:5])
+    writer.write(list(), primary[5:])
+    writer.close()
+    with open(f"{tmp_path}/all.geojson") as file:
+        expected = file.read()
+    with open(f"{tmp_path}/batches-new.geojson") as file:
+        assert file.read() == expected
+    with open(f"{tmp_path}/batches-out.geojson") as file:
+        assert json.load(file) == {"type": "FeatureCollection", "features": []}
+
+
+def test_checkpoint(tmp_path):
+    """Resuming from a checkpoint should finish with the same results."""
+    conflate = Conflator()
+    primary = f"{rootdir}/data/topo-test.geojson"
+    secondary = f"{rootdir}/data/osm.osm"
+    first = conflate.conflateData(primary, secondary, 7.0, checkpoint=str(tmp_path))
+    batches = sorted(tmp_path.glob("*/batch-*.pickle"))
+    assert batches
+    batches[-1].unlink()
+    second = conflate.conflateData(primary, secondary, 7.0, checkpoint=str(tmp_path))
+    for before, after in zip(first, second):
+        assert sorted(map(json.dumps, before)) == sorted(map(json.dumps, after))
+
+
+def test_runstore(tmp_path):
+    """Reusing the last run should give the same results."""
+    conflate = Conflator()
+    primary = f"{rootdir}/data/topo-test.geojson"
+    secondary = f"{rootdir}/data/osm.osm"
+    first = conflate.conflateData(primary, secondary, 7.0, runstore=f"{tmp_path}/runs.db")
+    store = RunStore(f"{tmp_path}/runs.db", 7.0, False, False)
+    # Nothing has changed, so all of the last run can be used
+    features = conflate.parseFile(primary)
+    existing = conflate.parseFile(secondary)
+    unchanged = store.compare(features, shapely.bounds(projectGeometries(features)),
+                              existing, shapely.bounds(projectGeometries(existing)), 7.0)
+    assert len(unchanged) == len(features)
+    second = conflate.conflateData(primary, secondary, 7.0, runstore=f"{tmp_path}/runs.db")
+    for before, after in zip(first, second):
+        assert sorted(map(json.dumps, before)) == sorted(map(json.dumps, after))
+
+
+def test_runstore_checkpoint(tmp_path):
+    """Using the last run and a checkpoint together shouldn't output anything twice."""
+    conflate = Conflator()
+    primary = f"{rootdir}/data/topo-test.geojson"
+    secondary = f"{rootdir}/data/osm.osm"
+    options = {"runstore": f"{tmp_path}/runs.db", "checkpoint": f"{tmp_path}/checkpoint"}
+    first = conflate.conflateData(primary, secondary, 7.0, **options)
+    assert sorted(tmp_path.glob("checkpoint/*/batch-*.pickle"))
+    second = conflate.conflateData(primary, secondary, 7.0, **options)
+    for before, after in zip(first, second):
+        assert sorted(map(json.dumps, before)) == sorted(map(json.dumps, after))
+
+
+def test_timing(tmp_path):
+    """The timing report should have every stage from the workers."""
+    conflate = Conflator()
+    conflate.conflateData(f"{rootdir}/data/topo-test.geojson", f"{rootdir}/data/osm.osm", 7.0, timing=f"{tmp_path}/timing.json")
+    with open(f"{tmp_path}/timing.json") as file:
+        report = json.load(file)
+    assert report["inputs"] == {"primary": 27, "secondary": 5100}
+    for name in ("nodecache", "datacache", "tagfilter"):
+        assert report["parameters"][name] is None
+    for name in ("load", "projection", "candidates", "distance", "slope", "tags"):
+        assert report["stages"][name]["calls"] > 0
+    highways = TagFilter(f"{rootdir}/data/highway.yaml")
+    conflate.conflateData(f"{rootdir}/data/topo-test.geojson", f"{rootdir}/data/osm.osm", 7.0, timing=f"{tmp_path}/timing.json",
+                          nodecache=f"{tmp_path}/nodes", tagfilter=highways, datacache=f"{tmp_path}/cache")
+    with open(f"{tmp_path}/timing.json") as file:
+        parameters = json.load(file)["parameters"]
+    assert parameters["nodecache"] == f"{tmp_path}/nodes"
+    assert parameters["datacache"] == f"{tmp_path}/cache"
+    assert parameters["tagfilter"] == json.loads(json.dumps(highways.config))
+
+
+def test_records():
+    """The records from a FeatureStore should be the same as from the features."""
+    conflate = Conflator()
+    secondary = conflate.parseFile(f"{rootdir}/data/osm.osm")
+    records = prepareSecondary(secondary)["records"]
+    stored = prepareSecondary(FeatureStore(secondary).select(numpy.arange(len(secondary))))["records"]
+    assert len(records) == len(stored) == len(secondary)
+    for record, other, feature in zip(records, stored, secondary):
+        for name in ("index", "id", "version", "geomtype", "tagcount", "tags"):
+            assert getattr(record, name) == getattr(other, name)
+        if record.refs is None:
+            assert other.refs is None
+        else:
+            assert record.refs.tolist() == other.refs.tolist() == feature["properties"]["refs"]
+
+
+def test_lazy_geometries():
+    """Only the geometries near a primary feature should be built."""
+    conflate = Conflator()
+    primary = conflate.parseFile(f"{rootdir}/data/topo-test.geojson")
+    secondary = conflate.parseFile(f"{rootdir}/data/osm.osm")
+    store = FeatureStore(secondary)
+    prepared = prepareSecondary(store)
+    eager = prepareSecondary(secondary)
+    assert conflateThread(primary, store, threshold=7.0, prepared=prepared) == conflateThread(primary, secondary, threshold=7.0)
+    geoms = prepared["geoms"]
+    assert 0 < geoms.built.sum() < len(secondary) / 10
+    built = numpy.flatnonzero(geoms.built)
+    assert list(geoms[built]) == list(eager["geoms"][built])
+    assert numpy.array_equal(geoms.endpoints(built), eager["geoms"].endpoints(built), equal_nan=True)
+
+
+def test_read_osm(tmp_path):
+    """Only tagged nodes and ways should be read from a OSM XML file."""
+    with open(f"{tmp_path}/small.osm", "w") as file:
+        file.write("""<?xml version='1.0' encoding='UTF-8'?>
+<osm version="0.6">
+  <node id="1" version="2" lat="40.0" lon="-105.0"/>
+  <node id="2" version="3" lat="40.1" lon="-105.1">
+    <tag k="highway" v="gate "/>
+  </node>
+  <node id="3" version="1" lat="40.2" lon="-105.2"/>
+  <way id="10" version="4">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <tag k="highway" v="track"/>
+  </way>
+  <relation id="20" version="1">
+    <member type="way" ref="10" role=""/>
+  </relation>
+</osm>
+""")
+    data = Conflator().loadFile(f"{tmp_path}/small.osm")
+    assert len(data) == 2
+    assert data[0]["properties"] == {"id": 2, "version": "3", "highway": "gate"}
+    assert data[1]["properties"]["version"] == "4"
+    assert data[1]["geometry"]["coordinates"] == [[-105.0, 40.0], [-105.1, 40.1]]
+    assert data[1]["properties"]["refs"] == [1, 2]
+
+
+def test_short_ways(tmp_path):
+    """Ways with less than 2 nodes that can be found should be skipped by every loader."""
+    with open(f"{tmp_path}/short.osm", "w") as file:
+        file.write("""<?xml version='1.0' encoding='UTF-8'?>
+<osm version="0.6">
+  <node id="1" version="1" lat="40.0" lon="-105.0"/>
+  <node id="2" version="1" lat="40.1" lon="-105.1"/>
+  <way id="10" version="1">
+    <nd ref="1"/>
+    <tag k="highway" v="track"/>
+  </way>
+  <way id="11" version="1">
+    <nd ref="2"/>
+    <nd ref="99"/>
+    <tag k="highway" v="track"/>
+  </way>
+  <way id="12" version="1">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <tag k="highway" v="track"/>
+  </way>
+</osm>
+""")
+    writer = osmium.SimpleWriter(f"{tmp_path}/short.osm.pbf")
+    for obj in osmium.FileProcessor(f"{tmp_path}/short.osm"):
+        writer.add(obj)
+    writer.close()
+    conflate = Conflator()
+    osmfile = f"{tmp_path}/short.osm"
+    for data in (conflate.loadFile(osmfile), conflate.readParallel(osmfile, 2),
+                 conflate.parseFile(f"{tmp_path}/short.osm.pbf")):
+        assert [feature["properties"]["id"] for feature in data] == [12]
+
+
+def test_load_pbf(tmp_path):
+    """A OSM PBF file should give the same features as the OSM XML file."""
+    writer = osmium.SimpleWriter(f"{tmp_path}/osm.osm.pbf")
+    for obj in osmium.FileProcessor(f"{rootdir}/data/osm.osm"):
+        writer.add(obj)
+    writer.close()
+    conflate = Conflator()
+    xml = conflate.parseFile(f"{rootdir}/data/osm.osm")
+    pbf = conflate.parseFile(f"{tmp_path}/osm.osm.pbf")
+    assert len(pbf) == len(xml)
+    for old, new in zip(xml, pbf):
+        assert shapely.geometry.shape(old["geometry"]).equals_exact(shapely.geometry.shape(new["geometry"]), 0)
+        assert old["properties"] == new["properties"]
+    highways = conflate.parseFile(f"{tmp_path}/osm.osm.pbf", TagFilter(f"{rootdir}/data/highway.yaml"))
+    assert 0 < len(highways) < len(xml)
+    assert all("highway" in feature["properties"] for feature in highways)
+
+
+def test_node_cache(tmp_path):
+    """Node locations in a cache directory should give the same ways, and be reused."""
+    conflate = Conflator()
+    data = conflate.parseFile(f"{rootdir}/data/osm.osm")
+    cached = conflate.parseFile(f"{rootdir}/data/osm.osm", cache=f"{tmp_path}/nodes")
+    assert json.dumps(cached) == json.dumps(data)
+    nodes = NodeCache(f"{tmp_path}/nodes", f"{rootdir}/data/osm.osm")
+    assert nodes.valid
+    assert len(nodes) == len([feature for feature in data if feature["geometry"]["type"] == "Point"])
+    way = data[-1]["properties"]
+    coords, found = nodes.locations(way["refs"] + [-1])
+    assert found.tolist() == [True] * len(way["refs"]) + [False]
+    assert numpy.allclose(coords, data[-1]["geometry"]["coordinates"], rtol=0, atol=1e-6)
+    assert json.dumps(conflate.parseFile(f"{rootdir}/data/osm.osm", cache=f"{tmp_path}/nodes")) == json.dumps(data)
+
+
+def test_parallel_load():
+    """Reading a OSM XML file in parts should give the same features."""
+    osmfile = f"{rootdir}/data/osm.osm"
+    ranges = findRanges(osmfile, 7)
+    assert len(ranges) == 7
+    with open(osmfile, "rb") as file:
+        for start, end in ranges:
+            file.seek(start)
+            assert file.read(5) in (b"<node", b"<way ", b"<rela")
+    conflate = Conflator()
+    assert json.dumps(conflate.loadFile(osmfile, processes=3)) == json.dumps(conflate.loadFile(osmfile, processes=1))
+
+
+def test_tag_filter(tmp_path):
+    """The features a filter keeps should be the same for every file format."""
+    osmfile = f"{rootdir}/data/osm.osm"
+    conflate = Conflator()
+    data = conflate.parseFile(osmfile)
+    highways = TagFilter(f"{rootdir}/data/highway.yaml")
+    expected = [feature for feature in data if highways.wants(feature)]
+    assert 0 < len(expected) < len(data)
+    assert all(feature["geometry"]["type"] == "LineString" for feature in expected)
+    assert conflate.parseFile(osmfile, highways) == expected
+    assert conflate.loadFile(osmfile, processes=3, tagfilter=highways) == expected
+
+    with open(f"{tmp_path}/data.geojson", "w") as file:
+        json.dump({"type": "FeatureCollection", "features": data}, file)
+    assert json.dumps(conflate.parseFile(f"{tmp_path}/data.geojson", highways)) == json.dumps(expected)
+
+    with open(f"{tmp_path}/highway.json", "w") as file:
+        json.dump({"filters": {"attributes": {"line": ["osm_id"]}, "tags": {"line": {"join_or": {"highway": []}}}}}, file)
+    assert conflate.parseFile(osmfile, TagFilter(f"{tmp_path}/highway.json")) == expected
+
+    with open(f"{tmp_path}/tracks.yaml", "w") as file:
+        file.write("from:\n  - nodes\n  - ways_line\n"
+                   "where:\n  tags:\n    - join_and:\n      - highway: track\n      - name: not null\n")
+    tracks = conflate.parseFile(osmfile, TagFilter(f"{tmp_path}/tracks.yaml"))
+    assert len(tracks) > 0
+    assert all(feature["properties"]["highway"] == "track" and "name" in feature["properties"] for feature in tracks)
+
+
+def test_stream_features(tmp_path):
+    """Streaming a GeoJson file should give the same features as loading it."""
+    filespec = f"{rootdir}/data/topo-test.geojson"
+    with open(filespec, "r") as file:
+        expected = geojson.load(file)["features"]
+    assert list(streamFeatures(filespec)) == expected
+    with open(filespec, "r") as file:
+        data = json.load(file)
+    with open(f"{tmp_path}/compact.geojson", "w") as file:
+        json.dump(data, file, separators=(",", ":"))
+    assert list(streamFeatures(f"{tmp_path}/compact.geojson")) == expected
+    batches = list(streamFeatures(filespec, 10))
+    assert [len(batch) for batch in batches] == [10, 10, 7]
+    assert sum(batches, []) == expected
+    for constant in ("NaN", "Infinity", "-Infinity"):
+        with open(f"{tmp_path}/bad.geojson", "w") as file:
+            file.write('{"type": "FeatureCollection", "features": [{"type": "Feature", '
+                       '"geometry": {"type": "Point", "coordinates": [%s, 40.0]}, "properties": {}}]}' % constant)
+        with pytest.raises(ValueError):
+            list(streamFeatures(f"{tmp_path}/bad.geojson"))
+
+
+def test_data_cache(tmp_path):
+    """A cached dataset should be the same as parsing the file again."""
+    conflate = Conflator()
+    filespec = f"{rootdir}/data/osm.osm"
+    data = conflate.parseFile(filespec, datacache=f"{tmp_path}/cache")
+    cached = conflate.parseFile(filespec, datacache=f"{tmp_path}/cache")
+    assert type(data) == list
+    assert isinstance(cached, FeatureStore)
+    assert isinstance(cached.arrays["wkb"], numpy.memmap)
+    assert len(cached) == len(data)
+    for feature, other in zip(data, cached):
+        assert feature["properties"] == other["properties"]
+    assert shapely.equals_exact(projectGeometries(data), projectGeometries(cached), 1e-6).all()
+    highways = conflate.parseFile(filespec, TagFilter(f"{rootdir}/data/highway.yaml"), datacache=f"{tmp_path}/cache")
+    assert type(highways) == list
+    assert len(os.listdir(f"{tmp_path}/cache")) == 2